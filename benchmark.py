@@ -0,0 +1,27 @@
+#!/usr/bin/python3
+
+import argparse
+
+import common
+
+__doc__ = "Micro-benchmarks of the request hot path"
+
+SUITES = {
+    "field": common.field.benchmark,
+    "header": common.header.benchmark,
+    "loop": common.server.benchmark,
+    "output": common.output.benchmark,
+    "prefix": common.prefix.benchmark,
+    "mask": common.websocket.benchmark
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("suite", nargs = "*", help = "Suites to run, all by default: " + ", ".join(sorted(SUITES)))
+    arguments = parser.parse_args()
+    for item in arguments.suite:
+        if item not in SUITES:
+            parser.error("unknown suite " + item)
+    for item in arguments.suite or sorted(SUITES):
+        print("##", item)
+        SUITES[item]()
@@ -1,11 +1,28 @@
 #!/usr/bin/python3.11
 
-import sys
-
+from . import admission
+from . import cache
+from . import compress
 from . import error
+from . import header
+from . import log
+from . import metrics
 from . import server
+from . import stream
+from . import startup
+from . import sysstat
+from . import watch
 from . import field
+from . import fastcgi
+from . import multipart
+from . import offload
+from . import respcache
+from . import websocket
+from . import hub
 from . import output
+from . import prefix
+from . import profiler
+from . import router
 
 ## 16M Max content
 MAX_CONTENT_LENGTH = 1048576 << 4
@@ -16,13 +33,18 @@ async def close_connection(stdout):
     "Close server connection"
     try:
         stdout.close()
-        if sys.version_info.minor >= 7:
-            await stdout.wait_closed()
+        await stdout.wait_closed()
     except ConnectionError:
-        print("Connection Error when closing connection.")
+        log.debug("Connection Error when closing connection.")
 
 ## Rebinding
 
 ResponseError = error.ResponseError
+Response = output.Response
+write_response = output.write_response
 write_email = output.write_email
+send_response = output.send_response
+send_file = output.send_file
+write_http = output.write_http
 parse_data = field.parse_data
+parse_header = header.parse_netstring
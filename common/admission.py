@@ -0,0 +1,76 @@
+#! /usr/bin/python3
+
+import asyncio
+import collections
+
+__doc__ = "Admission control - Concurrency slots, wait queue and buffered byte budget"
+
+class Admission():
+    """ Gate for new connections
+
+    At most max_requests connections are processed at once. Up to
+    queue_size more wait at most queue_timeout seconds for a slot, the
+    rest are turned away. Request bytes expected to be buffered are
+    reserved from byte_budget for the lifetime of the request.
+    """
+    def __init__(
+        self,
+        max_requests: int = 1024,
+        queue_size: int = 256,
+        queue_timeout: float = 5,
+        byte_budget: int = 1 << 28
+    ):
+        self.max_requests = max_requests
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.byte_budget = byte_budget
+        self.active = 0
+        self.buffered = 0
+        self.rejected = 0
+        self._waiters = collections.deque()
+    def __repr__(self) -> str:
+        return "".join((
+            "<Admission active=", str(self.active),
+            " waiting=", str(len(self._waiters)),
+            " buffered=", str(self.buffered),
+            " rejected=", str(self.rejected), " />"
+        ))
+    async def acquire(self) -> bool:
+        "Take a processing slot, False when the connection should be rejected"
+        if self.active < self.max_requests and not self._waiters:
+            self.active += 1
+            return True
+        if len(self._waiters) >= self.queue_size:
+            self.rejected += 1
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        return True
+    def release(self):
+        "Give the slot back, handing it straight to the next waiter"
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+    def reserve(self, size: int) -> bool:
+        "Account size buffered bytes, False when over budget"
+        if size < 0:
+            raise ValueError("Negative size " + str(size))
+        if size > 0 and self.buffered + size > self.byte_budget:
+            self.rejected += 1
+            return False
+        self.buffered += size
+        return True
+    def free(self, size: int):
+        "Return bytes taken by reserve"
+        self.buffered -= size
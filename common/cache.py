@@ -0,0 +1,67 @@
+#! /usr/bin/python3
+
+import collections
+import time
+
+__doc__ = "In-memory caches"
+
+class LRUCache():
+    """ Bounded mapping with least recently used eviction
+
+    Entries optionally expire ttl seconds after they were stored. With
+    maxbytes, the sizes given to put() are also kept under that total.
+    hits and misses count the outcome of get().
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = None, maxbytes: int = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+    def __repr__(self) -> str:
+        return "".join((
+            "<LRUCache size=", str(len(self._data)),
+            " bytes=", str(self.nbytes),
+            " hits=", str(self.hits),
+            " misses=", str(self.misses), " />"
+        ))
+    def __len__(self) -> int:
+        return len(self._data)
+    def __contains__(self, key) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and (entry[0] is None or entry[0] > time.monotonic())
+    def get(self, key, default=None):
+        "Return the cached value and mark it recently used"
+        entry = self._data.get(key)
+        if entry is not None:
+            if entry[0] is None or entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.pop(key)
+        self.misses += 1
+        return default
+    def put(self, key, value, ttl: float = None, size: int = 0):
+        "Store the value, evicting the least recently used entries if full"
+        ttl = self.ttl if ttl is None else ttl
+        self.pop(key)
+        self._data[key] = (None if ttl is None else time.monotonic() + ttl, value, size)
+        self.nbytes += size
+        while len(self._data) > self.maxsize or self.maxbytes is not None and self.nbytes > self.maxbytes:
+            self.nbytes -= self._data.popitem(last=False)[1][2]
+    def pop(self, key, default=None):
+        "Remove the entry and return its value"
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        self.nbytes -= entry[2]
+        return entry[1]
+    def clear(self):
+        "Drop every entry"
+        self._data.clear()
+        self.nbytes = 0
+    def stats(self) -> dict:
+        "Counters for reporting"
+        return {"size": len(self._data), "bytes": self.nbytes, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,169 @@
+#! /usr/bin/python3
+
+import zlib
+
+from . import cache
+from . import lazy
+from . import offload
+from . import stream
+
+zstandard = lazy.module("zstandard")
+
+__doc__ = "Content-Encoding negotiation and response body compression"
+
+## Encodings available here
+SUPPORTED = ("zstd", "gzip", "deflate") if zstandard is not None else ("gzip", "deflate")
+## Encodings in order of preference when the client accepts several
+ENCODINGS = list(SUPPORTED)
+LEVELS = {"zstd": 3, "gzip": 6, "deflate": 6}
+## Bodies below this size are not worth the CPU
+MIN_SIZE = 1024
+## Bodies above this size are compressed in the thread pool
+THREAD_SIZE = 1 << 16
+## Content types to compress, "type/*" matches the main type
+TYPES = {
+    "text/*", "application/json", "application/javascript", "application/xml",
+    "application/xhtml+xml", "image/svg+xml"
+}
+## Compressed bodies of responses with an ETag, by (ETag, encoding)
+CACHE = cache.LRUCache(maxsize = 256)
+## Larger bodies are not cached, which bounds the cache to maxsize times this
+CACHE_ENTRY_SIZE = 1 << 20
+
+def negotiate(accept: str) -> str:
+    "Pick the preferred encoding allowed by Accept-Encoding, None for identity"
+    if not accept:
+        return None
+    allowed = {}
+    for item in accept.split(","):
+        name, _, params = item.partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        allowed[name.strip().lower()] = quality
+    wildcard = allowed.get("*", 0)
+    for name in ENCODINGS:
+        if allowed.get(name, wildcard) > 0:
+            return name
+    return None
+
+def eligible(content_type: str) -> bool:
+    "Whether the content type is configured for compression"
+    content_type = content_type.split(";", 1)[0].strip().lower()
+    return content_type in TYPES or content_type.split("/", 1)[0] + "/*" in TYPES
+
+def compressor(encoding: str, level: int = None):
+    "Streaming compressor object with compress and flush"
+    level = LEVELS.get(encoding, 6) if level is None else level
+    if encoding == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level = level).compressobj()
+    raise ValueError("Unsupported encoding " + repr(encoding))
+
+def compress(encoding: str, segments: list) -> list:
+    "Compress the body segments chunk by chunk into a list of buffers"
+    engine = compressor(encoding)
+    result = []
+    for item in segments:
+        view = memoryview(item).cast("B")
+        for pos in range(0, len(view), stream.CHUNK_SIZE):
+            data = engine.compress(view[pos:pos + stream.CHUNK_SIZE])
+            if data:
+                result.append(data)
+    result.append(engine.flush())
+    return result
+
+def variant_etag(etag: str, encoding: str) -> str:
+    "ETag of the encoded representation - Strong ETags differ per encoding"
+    return etag[:-1] + "-" + encoding + '"' if etag.endswith('"') else etag
+
+def select(req, resp) -> str:
+    """ Encoding to apply to the Response, None to send it as is
+
+    Adds Vary: Accept-Encoding to responses of an eligible type.
+    """
+    if req is None or resp.status != 200 or "content-encoding" in resp or "content-range" in resp:
+        return None
+    if not eligible(resp.get("Content-Type", "text/plain")):
+        return None
+    if "vary" not in resp:
+        resp.add_header("Vary", "Accept-Encoding")
+    if len(resp) < MIN_SIZE:
+        return None
+    return negotiate(req.get("HTTP_ACCEPT_ENCODING"))
+
+def cacheable(resp) -> bool:
+    "Whether the compressed body may be kept in CACHE"
+    return "etag" in resp and "no-store" not in resp.get("Cache-Control", "") \
+        and len(resp) <= CACHE_ENTRY_SIZE
+
+def apply(resp, encoding: str, body: list):
+    "Replace the body of resp with its encoded form"
+    resp.body = body
+    resp.set_header("Content-Encoding", encoding)
+    if "content-length" in resp:
+        resp.set_header("Content-Length", str(len(resp)))
+    if "etag" in resp:
+        resp.set_header("ETag", variant_etag(resp["ETag"], encoding))
+    return resp
+
+def encode_inline(req, resp):
+    """ Compress resp on the loop when small enough
+
+    Bodies above THREAD_SIZE are left alone unless cached - send them
+    with output.send_response to have them compressed in a thread.
+    """
+    encoding = select(req, resp)
+    if encoding is None:
+        return resp
+    key = (resp["ETag"], encoding)
+    body = CACHE.get(key) if "etag" in resp else None
+    if body is None:
+        if len(resp) > THREAD_SIZE:
+            return resp
+        body = compress(encoding, resp.body)
+        if cacheable(resp):
+            CACHE.put(key, body)
+    return apply(resp, encoding, body)
+
+async def encode(req, resp):
+    "Compress resp, in the thread pool when its body is large"
+    encoding = select(req, resp)
+    if encoding is None:
+        return resp
+    key = (resp["ETag"], encoding)
+    body = CACHE.get(key) if "etag" in resp else None
+    if body is None:
+        if len(resp) > THREAD_SIZE:
+            body = await offload.run(offload.THREAD, compress, encoding, resp.body)
+        else:
+            body = compress(encoding, resp.body)
+        if cacheable(resp):
+            CACHE.put(key, body)
+    return apply(resp, encoding, body)
+
+def read_compressed(fin, engine) -> tuple:
+    """ Read fin until engine yields output
+
+    Returns (data, done) where done is set once the file is exhausted and
+    data holds the flushed remainder.
+    """
+    while True:
+        chunk = fin.read(stream.CHUNK_SIZE)
+        if not chunk:
+            return engine.flush(), True
+        data = engine.compress(chunk)
+        if data:
+            return data, False
+
+def compress_file(path: str, encoding: str) -> list:
+    "Compress a whole file into a list of buffers"
+    with open(path, "rb") as fin:
+        return compress(encoding, iter(lambda: fin.read(stream.CHUNK_SIZE), b""))
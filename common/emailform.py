@@ -0,0 +1,55 @@
+#! /usr/bin/python3
+
+import email.message
+import email.policy
+
+__doc__ = "Form fields of email.message multipart messages - Former field parser"
+
+class CGIFile(email.message.EmailMessage):
+    " Wrapper for CGI File Messages that behaves more like a file "
+    def __len__(self):
+        return len(self.get_payload(decode=True))
+    def __repr__(self):
+        return "".join((
+            '<file name="',
+            self["content-disposition"].params.get("name"),
+            '" filename="',
+            self.get_filename() or "None",
+            '" size=',
+            str(len(self)),
+            ' />'
+        ))
+
+def process_multipart_formdata(stdin: email.message.Message) -> dict:
+    "Format conversion to make multipart a regular message"
+    result = {}
+    for item in stdin.get_payload():
+        contdisp = item["content-disposition"]
+        if contdisp.params.get("name") is None:
+            ## Not an entry to the form
+            continue
+        if item.get_filename() is None and item.get_content_type() == "text/plain":
+            ## A text field
+            try:
+                payload = item.get_payload(decode=True).decode("utf-8")
+            except UnicodeDecodeError:
+                ## Cannot decode
+                continue
+            result[contdisp.params.get("name")] = payload
+        elif item.get_content_maintype() == "multipart":
+            ## Layered multipart/form-data
+            payload = []
+            for subitem in item.get_payload():
+                if subitem.get_content_maintype() == "multipart":
+                    continue # Too many layers of multipart. Skip it.
+                payload.append(
+                    item if isinstance(item, CGIFile) \
+                        else email.message_from_string(str(item), CGIFile, policy=email.policy.HTTP)
+                )
+            if payload:
+                result[contdisp.params.get("name")] = payload
+        else:
+            ## This is a single attached file. Store the file content.
+            result[contdisp.params.get("name")] = item if isinstance(item, CGIFile) \
+                else email.message_from_string(str(item),CGIFile, policy=email.policy.HTTP)
+    return result
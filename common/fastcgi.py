@@ -0,0 +1,321 @@
+#! /usr/bin/python3
+
+import asyncio
+import struct
+
+from . import error
+from . import header
+from . import log
+from . import stream
+
+__doc__ = "FastCGI responder - Multiplexed requests over persistent connections"
+
+## Record types
+BEGIN_REQUEST, ABORT_REQUEST, END_REQUEST, PARAMS, STDIN, STDOUT, STDERR, DATA = range(1, 9)
+GET_VALUES, GET_VALUES_RESULT, UNKNOWN_TYPE = range(9, 12)
+## Roles and the flag of BEGIN_REQUEST
+RESPONDER = 1
+KEEP_CONN = 1
+## Protocol status of END_REQUEST
+REQUEST_COMPLETE, CANT_MPX_CONN, OVERLOADED, UNKNOWN_ROLE = range(4)
+
+## Requests in progress on one connection, beyond that they are refused as overloaded
+MAX_REQUESTS = 64
+## Connections advertised to the web server in FCGI_MAX_CONNS
+MAX_CONNS = 1024
+## Seconds a connection without requests in progress stays open, 0 for ever
+IDLE_TIMEOUT = 300
+
+## version, type, request id, content length, padding length
+HEADER = struct.Struct("!BBHHBx")
+## role, flags
+_BEGIN = struct.Struct("!HB5x")
+## application status, protocol status
+_END = struct.Struct("!IB3x")
+MAX_CONTENT = 65535
+
+## Connections being served, closed once idle by shutdown
+CONNECTIONS = set()
+
+def parse_params(data) -> header.Header:
+    """ Decode FastCGI name-value pairs into a Header
+
+    Lengths below 128 take one byte, longer ones four with the high bit set.
+    Raises ResponseError 400 when a pair runs past the end of data.
+    """
+    data = bytes(data)
+    result = {}
+    pos = 0
+    end = len(data)
+    try:
+        while pos < end:
+            size = data[pos]
+            if size & 0x80:
+                size = int.from_bytes(data[pos:pos + 4], "big") & 0x7fffffff
+                pos += 4
+            else:
+                pos += 1
+            value = data[pos]
+            if value & 0x80:
+                value = int.from_bytes(data[pos:pos + 4], "big") & 0x7fffffff
+                pos += 4
+            else:
+                pos += 1
+            if pos + size + value > end:
+                raise IndexError()
+            result[str(data[pos:pos + size], "utf-8", "surrogateescape")] = \
+                str(data[pos + size:pos + size + value], "utf-8", "surrogateescape")
+            pos += size + value
+    except IndexError as err:
+        raise error.ResponseError(400, "Payload malformed") from err
+    return header.Header(result)
+
+def _length(size: int) -> bytes:
+    return bytes((size,)) if size < 0x80 else (size | 0x80000000).to_bytes(4, "big")
+
+def encode_params(params: dict) -> bytes:
+    "Encode name-value pairs, the reverse of parse_params"
+    result = []
+    for name, value in params.items():
+        name = str(name).encode("utf-8", "surrogateescape")
+        value = str(value).encode("utf-8", "surrogateescape")
+        result += (_length(len(name)), _length(len(value)), name, value)
+    return b"".join(result)
+
+def records(kind: int, request_id: int, data=b"") -> list:
+    """ Records of kind carrying data, split at the size limit
+
+    Empty data gives one empty record, which ends PARAMS, STDIN and STDOUT.
+    """
+    if not data:
+        return [HEADER.pack(1, kind, request_id, 0, 0)]
+    result = []
+    data = memoryview(data)
+    for pos in range(0, len(data), MAX_CONTENT):
+        chunk = data[pos:pos + MAX_CONTENT]
+        result += (HEADER.pack(1, kind, request_id, len(chunk), 0), chunk)
+    return result
+
+class _Flow():
+    """ Transport stand-in of the request StreamReader
+
+    The reader pauses it when a handler lets the body pile up, which stops
+    reading records from the connection until every handler catches up.
+    """
+    __slots__ = ("connection", "paused")
+    def __init__(self, connection):
+        self.connection = connection
+        self.paused = False
+    def pause_reading(self):
+        "Called by StreamReader above twice its limit"
+        if not self.paused:
+            self.paused = True
+            self.connection.paused += 1
+            self.connection.resumed.clear()
+    def resume_reading(self):
+        "Called by StreamReader once drained below its limit, and when the request ends"
+        if self.paused:
+            self.paused = False
+            self.connection.paused -= 1
+            if not self.connection.paused:
+                self.connection.resumed.set()
+    def get_extra_info(self, _, default=None):
+        "Nothing to tell"
+        return default
+
+class RecordWriter():
+    """ StreamWriter of one request, writing STDOUT records
+
+    Closing it ends the request. The connection stays open when the web
+    server asked to keep it, there is no transport to sendfile on.
+    """
+    __slots__ = ("connection", "request_id", "closed")
+    def __init__(self, connection, request_id: int):
+        self.connection = connection
+        self.request_id = request_id
+        self.closed = False
+    def __repr__(self) -> str:
+        return "<RecordWriter request=" + str(self.request_id) + " />"
+    def write(self, data):
+        "Send data in STDOUT records"
+        if data and not self.closed and not self.connection.stdout.is_closing():
+            self.connection.stdout.writelines(records(STDOUT, self.request_id, data))
+    def writelines(self, data):
+        "Send every item in STDOUT records"
+        self.write(b"".join(data))
+    async def drain(self):
+        "Wait until the connection can take more"
+        await self.connection.stdout.drain()
+    def is_closing(self) -> bool:
+        "True once the request ended or the connection closes"
+        return self.closed or self.connection.stdout.is_closing()
+    def close(self):
+        "End the request"
+        if not self.closed:
+            self.closed = True
+            self.connection.end(self.request_id)
+    async def wait_closed(self):
+        "Wait until the end of the request is flushed"
+        await self.connection.stdout.drain()
+    def get_extra_info(self, name, default=None):
+        "Socket information of the connection"
+        return self.connection.stdout.get_extra_info(name, default)
+
+class Request():
+    " State of one request on a connection "
+    __slots__ = ("request_id", "keep", "params", "flow", "stdin", "stdout", "task")
+    def __init__(self, connection, request_id: int, keep: bool, limit: int):
+        self.request_id = request_id
+        self.keep = keep
+        self.params = bytearray()
+        self.flow = _Flow(connection)
+        self.stdin = asyncio.StreamReader(limit)
+        self.stdin.set_transport(self.flow)
+        self.stdout = RecordWriter(connection, request_id)
+        self.task = None
+
+class Connection():
+    """ One web server connection carrying requests for handler
+
+    handler(header, stdin, stdout) is started for every request once its
+    parameters arrived, with the body fed to stdin as STDIN records come.
+    Requests are ended by closing stdout. The connection is closed after a
+    request without KEEP_CONN, on EOF, or by close once idle.
+    """
+    def __init__(self, stdin, stdout, handler, max_params: int = 1 << 20, limit: int = 1 << 16):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.handler = handler
+        self.max_params = max_params
+        self.limit = limit
+        self.requests = {}
+        ## Request bodies waiting for their handler to read them
+        self.paused = 0
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.closing = False
+        self._idle = None
+    def __repr__(self) -> str:
+        return "<Connection requests=" + str(len(self.requests)) + " />"
+
+    async def serve(self):
+        "Read records until the connection ends"
+        CONNECTIONS.add(self)
+        try:
+            self._wait()
+            while True:
+                if self.paused:
+                    await self.resumed.wait()
+                head = await self.stdin.readexactly(HEADER.size)
+                _, kind, request_id, size, padding = HEADER.unpack(head)
+                content = await self.stdin.readexactly(size + padding) if size + padding else b""
+                if padding:
+                    content = content[:size]
+                self.record(kind, request_id, content)
+        except (asyncio.IncompleteReadError, ConnectionError, TimeoutError):
+            pass
+        finally:
+            CONNECTIONS.discard(self)
+            if self._idle is not None:
+                self._idle.cancel()
+            for request in list(self.requests.values()):
+                if request.task is not None:
+                    request.task.cancel()
+            self.requests.clear()
+            try:
+                self.stdout.close()
+                await self.stdout.wait_closed()
+            except ConnectionError:
+                pass
+
+    def _wait(self):
+        "Time the connection out unless a request comes"
+        if IDLE_TIMEOUT and self._idle is None and not self.requests:
+            self._idle = stream.deadline(self.stdin, IDLE_TIMEOUT)
+
+    def record(self, kind: int, request_id: int, content: bytes):
+        "Act on one record"
+        if request_id == 0:
+            if kind == GET_VALUES:
+                values = {"FCGI_MAX_CONNS": MAX_CONNS, "FCGI_MAX_REQS": MAX_REQUESTS, "FCGI_MPXS_CONNS": 1}
+                asked = parse_params(content)
+                self.stdout.writelines(records(GET_VALUES_RESULT, 0, encode_params(
+                    {name: value for name, value in values.items() if name in asked}
+                )))
+            else:
+                self.stdout.writelines(records(UNKNOWN_TYPE, 0, bytes((kind,)) + bytes(7)))
+            return
+        if kind == BEGIN_REQUEST:
+            role, flags = _BEGIN.unpack(content)
+            if role != RESPONDER:
+                self.stdout.writelines(records(END_REQUEST, request_id, _END.pack(0, UNKNOWN_ROLE)))
+            elif self.closing or request_id in self.requests or len(self.requests) >= MAX_REQUESTS:
+                self.stdout.writelines(records(END_REQUEST, request_id, _END.pack(0, OVERLOADED)))
+            else:
+                if self._idle is not None:
+                    self._idle.cancel()
+                    self._idle = None
+                self.requests[request_id] = Request(self, request_id, bool(flags & KEEP_CONN), self.limit)
+            return
+        request = self.requests.get(request_id)
+        if request is None:
+            return
+        if kind == PARAMS and request.task is None:
+            if content:
+                request.params += content
+                if len(request.params) > self.max_params:
+                    error.ResponseError(431, "Payload head too large").write(None, request.stdout)
+                    request.stdout.close()
+            else:
+                request.task = asyncio.get_running_loop().create_task(self._run(request))
+                ## Also ends requests aborted before their task started
+                request.task.add_done_callback(lambda _: request.stdout.close())
+        elif kind == STDIN:
+            if content:
+                request.stdin.feed_data(content)
+            else:
+                request.stdin.feed_eof()
+        elif kind == ABORT_REQUEST:
+            if request.task is None:
+                request.stdout.close()
+            else:
+                request.task.cancel()
+
+    async def _run(self, request: Request):
+        try:
+            params, request.params = request.params, None
+            await self.handler(parse_params(params), request.stdin, request.stdout)
+        except error.ResponseError as err:
+            err.write(None, request.stdout)
+        except Exception: #pylint: disable=broad-except
+            log.exception("FastCGI request", request.request_id, "failed")
+
+    def end(self, request_id: int):
+        "Finish the request, closing the connection if it was its last"
+        request = self.requests.pop(request_id, None)
+        if request is None:
+            return
+        request.flow.resume_reading()
+        if self.stdout.is_closing():
+            return
+        self.stdout.writelines(
+            records(STDOUT, request_id) + records(END_REQUEST, request_id, _END.pack(0, REQUEST_COMPLETE))
+        )
+        if not request.keep:
+            self.closing = True
+        if self.closing and not self.requests:
+            self.close()
+        else:
+            self._wait()
+
+    def close(self):
+        "Close now when idle, otherwise once the requests in progress end"
+        self.closing = True
+        if not self.requests:
+            ## Wakes the record loop, which leaves on ConnectionError
+            self.stdin.set_exception(ConnectionAbortedError())
+
+def shutdown():
+    "Close every connection once its requests end"
+    for connection in list(CONNECTIONS):
+        connection.close()
@@ -0,0 +1,182 @@
+#! /usr/bin/python3
+
+import time
+
+from . import error
+
+__doc__ = "SCGI netstring header parser"
+
+class Header():
+    """ Case-preserving mapping of SCGI header variables
+
+    Lookups try the exact name first and fall back to a case-insensitive
+    match, so it also serves handlers written against email.message.Message.
+    form holds the request data decoded by common.field.parse_data, so the
+    body is only read once.
+    """
+    __slots__ = ("_data", "_lower", "form")
+
+    def __init__(self, data: dict = None):
+        self._data = {} if data is None else data
+        self._lower = None
+        self.form = None
+
+    def _key(self, name: str):
+        "Resolve name into the stored key, or None when absent"
+        if name in self._data:
+            return name
+        if self._lower is None:
+            self._lower = {item.lower(): item for item in self._data}
+        return self._lower.get(name.lower())
+
+    def __contains__(self, name) -> bool:
+        return self._key(name) is not None
+
+    def __getitem__(self, name: str):
+        "Return the value, or None when absent like email.message.Message"
+        key = self._key(name)
+        return None if key is None else self._data[key]
+
+    def __setitem__(self, name: str, value: str):
+        key = self._key(name)
+        if key is not None:
+            name = key
+        elif self._lower is not None:
+            self._lower[name.lower()] = name
+        self._data[name] = value
+
+    def __delitem__(self, name: str):
+        key = self._key(name)
+        if key is not None:
+            del self._data[key]
+            self._lower = None
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __repr__(self) -> str:
+        return "<Header fields=" + str(len(self._data)) + " />"
+
+    def __str__(self) -> str:
+        return "".join(item[0] + ": " + item[1] + "\n" for item in self._data.items()) + "\n"
+
+    def __bytes__(self) -> bytes:
+        return str(self).encode("utf-8", "surrogateescape")
+
+    def get(self, name: str, default=None):
+        "Return the value or default"
+        key = self._key(name)
+        return default if key is None else self._data[key]
+
+    def keys(self):
+        "Header names"
+        return self._data.keys()
+
+    def values(self):
+        "Header values"
+        return self._data.values()
+
+    def items(self):
+        "Header name - value pairs"
+        return self._data.items()
+
+    def as_dict(self) -> dict:
+        "Plain dict copy of the header variables"
+        return dict(self._data)
+
+    ## email.message.Message compatibility
+
+    def add_header(self, name: str, value: str, **_):
+        "Set a header variable"
+        self[name] = value
+
+    def replace_header(self, name: str, value: str):
+        "Replace an existing header variable"
+        if name not in self:
+            raise KeyError(name)
+        self[name] = value
+
+    def get_content_type(self) -> str:
+        "Content type in lower case, text/plain when missing or invalid"
+        value = self.get("CONTENT_TYPE") or ""
+        value = value.split(";", 1)[0].strip().lower()
+        return value if value.count("/") == 1 else "text/plain"
+
+    def get_content_maintype(self) -> str:
+        "Main type of the content type"
+        return self.get_content_type().split("/", 1)[0]
+
+    def get_content_subtype(self) -> str:
+        "Sub type of the content type"
+        return self.get_content_type().split("/", 1)[1]
+
+    def get_param(self, param: str, failobj=None):
+        "Get a parameter of the content type"
+        for item in (self.get("CONTENT_TYPE") or "").split(";")[1:]:
+            key, sep, value = item.partition("=")
+            if sep and key.strip().lower() == param.lower():
+                return value.strip().strip('"')
+        return failobj
+
+    def get_content_charset(self, failobj=None):
+        "Charset parameter of the content type"
+        charset = self.get_param("charset")
+        return charset.lower() if charset else failobj
+
+def parse_netstring(data) -> Header:
+    """ Parse the SCGI header netstring payload into a Header
+
+    data is the netstring content without the length prefix and trailing
+    comma, as bytes, bytearray or memoryview. The whole payload is decoded
+    to one str and split on NUL, so each field is copied once from it,
+    rather than decoded field by field.
+    """
+    text = str(data, "utf-8", "surrogateescape")
+    if not text.endswith("\0"):
+        raise error.ResponseError(400, "Payload malformed")
+    fields = text.split("\0")
+    ## The trailing NUL leaves one empty field behind
+    fields.pop()
+    if len(fields) & 1:
+        raise error.ResponseError(400, "Payload malformed")
+    fields = iter(fields)
+    return Header(dict(zip(fields, fields)))
+
+def _email_parse(data: bytes):
+    "Previous parser based on the email module, kept for benchmarking"
+    import email.parser
+    import email.policy
+    data = data.split(b"\0")
+    data = [data[item << 1:(item + 1) << 1] for item in range(len(data) >> 1)]
+    data = b"\n".join((b": ".join(item) for item in data))
+    return email.parser.BytesParser(policy = email.policy.default).parsebytes(
+        data, headersonly=True
+    )
+
+def _sample_netstring(count: int) -> bytes:
+    "Build a header netstring payload with count variables"
+    fields = [
+        ("CONTENT_LENGTH", "0"), ("SCGI", "1"), ("REQUEST_METHOD", "GET"),
+        ("REQUEST_URI", "/scgi/debug?a=1"), ("HTTP_USER_AGENT", "Mozilla/5.0 (X11; Linux)")
+    ]
+    fields += [("HTTP_X_VAR_" + str(item), "value-" + str(item) * 8) for item in range(count - len(fields))]
+    return b"".join(item[0].encode("ascii") + b"\0" + item[1].encode("ascii") + b"\0" for item in fields)
+
+def benchmark(counts: tuple = (20, 50, 200), duration: float = 1):
+    "Compare requests per second of parse_netstring against the email parser"
+    for count in counts:
+        data = _sample_netstring(count)
+        for name, fun in (("email", _email_parse), ("netstring", parse_netstring)):
+            done = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < duration:
+                for _ in range(100):
+                    _ = fun(data)["CONTENT_LENGTH"]
+                done += 100
+            print(
+                str(count).rjust(4), "vars", name.ljust(10),
+                str(int(done / (time.perf_counter() - start))).rjust(9), "req/s"
+            )
@@ -0,0 +1,170 @@
+#! /usr/bin/python3
+
+import os
+import time
+import zlib
+
+from . import websocket
+
+__doc__ = "Publish and subscribe hub fanning messages out to WebSocket sessions"
+
+## What to do with a subscriber whose send queue is full
+SAMPLE, DROP = "sample", "drop"
+## Default for new channels, set from config.ini
+POLICY = SAMPLE
+## Close code sent to dropped subscribers - Try again later
+CLOSE_TRY_AGAIN = 1013
+
+def encode(opcode: int, data: bytes, deflate: websocket.PerMessageDeflate = None) -> tuple:
+    """ A whole message frame as an immutable tuple of buffers
+
+    With deflate, the payload is compressed on its own with a fresh
+    context. Only receivers that negotiated server_no_context_takeover
+    may get it: the others decode with one window for the connection,
+    which the session compresses its own messages against.
+    """
+    if deflate is None:
+        return tuple(websocket.encode_frame(opcode, data))
+    engine = zlib.compressobj(deflate.level, zlib.DEFLATED, -deflate.server_bits)
+    payload = engine.compress(data) + engine.flush(zlib.Z_SYNC_FLUSH)
+    return tuple(websocket.encode_frame(opcode, payload[:-4], True, 4))
+
+class Channel():
+    """ Named set of subscribed sessions with fan-out counters
+
+    policy decides the fate of a subscriber that cannot take the message
+    right away: SAMPLE skips the message for it, DROP closes it.
+    """
+    __slots__ = (
+        "name", "policy", "subscribers", "published", "deliveries",
+        "skipped", "dropped", "bytes_out", "encode_seconds", "fanout_seconds"
+    )
+    def __init__(self, name: str, policy: str = None):
+        self.name = name
+        self.policy = policy or POLICY
+        self.subscribers = set()
+        self.published = 0
+        self.deliveries = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.bytes_out = 0
+        self.encode_seconds = 0.0
+        self.fanout_seconds = 0.0
+    def __repr__(self) -> str:
+        return "".join((
+            '<Channel name="', self.name, '" subscribers=', str(len(self.subscribers)),
+            " published=", str(self.published), " />"
+        ))
+    def __len__(self) -> int:
+        return len(self.subscribers)
+
+    def publish(self, data, binary: bool = None) -> int:
+        """ Queue the message on every subscriber without waiting
+
+        str is sent as text, anything else as binary. Frames are built once
+        per encoding in use and shared. Sessions with server context
+        takeover get the uncompressed frame, see encode. Returns the number
+        of deliveries.
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+            binary = False if binary is None else binary
+        else:
+            data = bytes(data)
+        opcode = websocket.OPCODE_BINARY if binary or binary is None else websocket.OPCODE_TEXT
+        started = time.perf_counter()
+        frames = {None: encode(opcode, data)}
+        encoded = time.perf_counter()
+        size = len(data)
+        delivered = 0
+        for session in list(self.subscribers):
+            if session.closed:
+                self.subscribers.discard(session)
+                continue
+            deflate = session.deflate
+            key = None
+            if deflate is not None and not deflate.server_takeover and size >= deflate.min_size:
+                key = (deflate.server_bits, deflate.level)
+                if key not in frames:
+                    start = time.perf_counter()
+                    frames[key] = encode(opcode, data, deflate)
+                    ## Compression counts as encoding, not fan-out
+                    encoded += time.perf_counter() - start
+            frame = frames[key]
+            if session.offer(frame):
+                delivered += 1
+                self.bytes_out += len(frame[0]) + (len(frame[1]) if len(frame) > 1 else 0)
+            elif self.policy == DROP:
+                self.subscribers.discard(session)
+                session.abort(CLOSE_TRY_AGAIN, "Too slow")
+                self.dropped += 1
+            else:
+                self.skipped += 1
+        finished = time.perf_counter()
+        self.published += 1
+        self.deliveries += delivered
+        self.encode_seconds += encoded - started
+        self.fanout_seconds += finished - encoded
+        return delivered
+
+class Hub():
+    " Channels by name "
+    def __init__(self):
+        self.channels = {}
+    def __repr__(self) -> str:
+        return "<Hub channels=" + str(len(self.channels)) + " />"
+    def channel(self, name: str, policy: str = None) -> Channel:
+        "Return the channel, creating it on first use"
+        result = self.channels.get(name)
+        if result is None:
+            result = self.channels[name] = Channel(name, policy)
+        elif policy is not None:
+            result.policy = policy
+        return result
+    def subscribe(self, name: str, session: websocket.Session) -> Channel:
+        "Add the session to the channel"
+        result = self.channel(name)
+        result.subscribers.add(session)
+        return result
+    def unsubscribe(self, name: str, session: websocket.Session):
+        "Remove the session from the channel"
+        channel = self.channels.get(name)
+        if channel is not None:
+            channel.subscribers.discard(session)
+    def unsubscribe_all(self, session: websocket.Session):
+        "Remove the session from every channel"
+        for channel in self.channels.values():
+            channel.subscribers.discard(session)
+    def publish(self, name: str, data, binary: bool = None) -> int:
+        "Publish on the channel, 0 when nobody listens"
+        channel = self.channels.get(name)
+        return channel.publish(data, binary) if channel is not None else 0
+    def render(self) -> str:
+        "Channel counters in Prometheus text format"
+        lines = []
+        pid = 'pid="' + str(os.getpid()) + '"'
+        for metric, kind, attr, text in (
+            ("scgi_hub_subscribers", "gauge", "subscribers", "Sessions subscribed by channel."),
+            ("scgi_hub_messages_total", "counter", "published", "Messages published by channel."),
+            ("scgi_hub_deliveries_total", "counter", "deliveries", "Messages queued on subscribers."),
+            ("scgi_hub_skipped_total", "counter", "skipped", "Messages skipped for slow subscribers."),
+            ("scgi_hub_dropped_total", "counter", "dropped", "Slow subscribers closed."),
+            ("scgi_hub_sent_bytes_total", "counter", "bytes_out", "Frame bytes queued by channel."),
+            ("scgi_hub_encode_seconds_total", "counter", "encode_seconds", "Time framing messages."),
+            ("scgi_hub_fanout_seconds_total", "counter", "fanout_seconds", "Time queueing frames on subscribers.")
+        ):
+            lines.append("# HELP " + metric + " " + text)
+            lines.append("# TYPE " + metric + " " + kind)
+            for name, channel in sorted(self.channels.items()):
+                value = getattr(channel, attr)
+                value = len(value) if isinstance(value, set) else value
+                name = name.replace("\\", "\\\\").replace('"', '\\"')
+                lines.append(metric + "{" + pid + ',channel="' + name + '"} ' + str(value))
+        return "\n".join(lines) + "\n"
+
+HUB = Hub()
+subscribe = HUB.subscribe
+unsubscribe = HUB.unsubscribe
+unsubscribe_all = HUB.unsubscribe_all
+publish = HUB.publish
+render = HUB.render
@@ -0,0 +1,31 @@
+#! /usr/bin/python3
+
+import importlib.util
+import sys
+
+__doc__ = "Modules imported on first attribute access instead of at startup"
+
+def module(name: str):
+    """ Return the module name, executed only when an attribute is first used
+
+    Returns None when the module is not installed, like the
+    "try: import except ImportError: None" idiom it replaces. A module
+    already imported is returned as is.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or spec.loader is None or not hasattr(spec.loader, "exec_module"):
+        return None
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    result = importlib.util.module_from_spec(spec)
+    sys.modules[name] = result
+    spec.loader.exec_module(result)
+    if "." in name:
+        ## Make it reachable from the parent like a regular import
+        parent, _, child = name.rpartition(".")
+        setattr(sys.modules[parent], child, result)
+    return result
@@ -0,0 +1,108 @@
+#! /usr/bin/python3
+
+import asyncio
+import sys
+import time
+import traceback
+
+__doc__ = "Buffered, level-filtered logging kept off the request path"
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+class Log():
+    """ Log lines are buffered and written in one go
+
+    Inside an event loop the buffer is flushed flush_interval seconds after
+    the first pending line, or as soon as it holds max_buffer lines.
+    Outside a loop every line is written at once.
+    """
+    def __init__(self, stream=None, level: int = INFO, flush_interval: float = 0.5, max_buffer: int = 256):
+        self.stream = stream
+        self.level = level
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._buffer = []
+        self._timer = None
+    def __repr__(self) -> str:
+        return "<Log level=" + str(self.level) + " pending=" + str(len(self._buffer)) + " />"
+    def enabled(self, level: int) -> bool:
+        "Whether lines of the level are kept"
+        return self.stream is not False and level >= self.level
+    def log(self, level: int, *args):
+        "Queue a line made of args joined by space"
+        if self.stream is False or level < self.level:
+            return
+        self._buffer.append(" ".join(str(item) for item in args) + "\n")
+        if len(self._buffer) >= self.max_buffer:
+            self.flush()
+        elif self._timer is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.flush()
+                return
+            self._timer = loop.call_later(self.flush_interval, self.flush)
+    def debug(self, *args):
+        "Log at DEBUG level"
+        self.log(DEBUG, *args)
+    def info(self, *args):
+        "Log at INFO level"
+        self.log(INFO, *args)
+    def warning(self, *args):
+        "Log at WARNING level"
+        self.log(WARNING, *args)
+    def error(self, *args):
+        "Log at ERROR level"
+        self.log(ERROR, *args)
+    def exception(self, *args):
+        "Log at ERROR level with the traceback being handled"
+        self.log(ERROR, *args, "\n" + traceback.format_exc().rstrip())
+    def flush(self):
+        "Write out every pending line"
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+        data, self._buffer = "".join(self._buffer), []
+        stream = self.stream or sys.stdout
+        try:
+            stream.write(data)
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+
+## Server messages
+LOG = Log()
+## One line per request - Disabled until configured
+ACCESS = Log(stream = False)
+
+def open_stream(target: str):
+    "Map a config value to a stream: - for stdout, empty to disable, else a file"
+    if not target:
+        return False
+    if target == "-":
+        return None
+    return open(target, "a", encoding = "utf-8")
+
+def access(header, status: int, size: int, duration: float):
+    "Record one request in the access log"
+    if ACCESS.stream is False:
+        return
+    ACCESS.info(
+        header.get("REMOTE_ADDR", "-"),
+        time.strftime("[%d/%b/%Y:%H:%M:%S %z]"),
+        '"' + str(header.get("REQUEST_METHOD")) + " " + str(header.get("REQUEST_URI")) + '"',
+        status, size, "%.3f" % (duration * 1000)
+    )
+
+debug = LOG.debug
+info = LOG.info
+warning = LOG.warning
+error = LOG.error
+exception = LOG.exception
+flush = LOG.flush
@@ -0,0 +1,135 @@
+#! /usr/bin/python3
+
+import bisect
+import os
+
+__doc__ = "Request counters and latency histograms in Prometheus text format"
+
+## Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+## Route label for requests that matched no handler
+NO_ROUTE = "-"
+
+class Histogram():
+    " Fixed bucket histogram "
+    __slots__ = ("bounds", "counts", "sum", "count")
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self.bounds = bounds
+        ## The last slot collects everything above the largest bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, value: float):
+        "Record one value"
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+    def render(self, name: str, labels: str) -> list:
+        "Prometheus lines of the histogram"
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + ("+Inf",), self.counts):
+            total += count
+            result.append(name + '_bucket{' + labels + ',le="' + str(bound) + '"} ' + str(total))
+        result.append(name + "_sum{" + labels + "} " + repr(self.sum))
+        result.append(name + "_count{" + labels + "} " + str(self.count))
+        return result
+
+class RouteStats():
+    " Counters of one route "
+    __slots__ = ("requests", "status", "bytes_in", "bytes_out", "parse", "handler", "drain")
+    def __init__(self):
+        self.requests = 0
+        self.status = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.parse = Histogram()
+        self.handler = Histogram()
+        self.drain = Histogram()
+
+ROUTES = {}
+
+def route(name: str) -> RouteStats:
+    "Stats of the route, created on first use"
+    name = name or NO_ROUTE
+    stats = ROUTES.get(name)
+    if stats is None:
+        stats = ROUTES[name] = RouteStats()
+    return stats
+
+def record(name: str, status: int, bytes_in: int, bytes_out: int, timing: tuple):
+    "Record a finished request - timing is (parse, handler, drain) in seconds"
+    stats = route(name)
+    stats.requests += 1
+    stats.status[status] = stats.status.get(status, 0) + 1
+    stats.bytes_in += bytes_in
+    stats.bytes_out += bytes_out
+    stats.parse.observe(timing[0])
+    stats.handler.observe(timing[1])
+    stats.drain.observe(timing[2])
+
+def render() -> str:
+    "All metrics in Prometheus text exposition format"
+    lines = [
+        "# HELP scgi_requests_total Requests handled by route and status.",
+        "# TYPE scgi_requests_total counter"
+    ]
+    pid = 'pid="' + str(os.getpid()) + '"'
+    for name, stats in sorted(ROUTES.items()):
+        for status, count in sorted(stats.status.items()):
+            lines.append(
+                'scgi_requests_total{' + pid + ',route="' + name + '",status="' + str(status) + '"} ' + str(count)
+            )
+    for metric, attr, text in (
+        ("scgi_received_bytes_total", "bytes_in", "Request bytes received by route."),
+        ("scgi_sent_bytes_total", "bytes_out", "Response bytes sent by route.")
+    ):
+        lines.append("# HELP " + metric + " " + text)
+        lines.append("# TYPE " + metric + " counter")
+        for name, stats in sorted(ROUTES.items()):
+            lines.append(metric + "{" + pid + ',route="' + name + '"} ' + str(getattr(stats, attr)))
+    for metric, attr, text in (
+        ("scgi_parse_seconds", "parse", "Time reading and parsing the SCGI header."),
+        ("scgi_handler_seconds", "handler", "Time spent in the route handler."),
+        ("scgi_drain_seconds", "drain", "Time flushing the response to the socket.")
+    ):
+        lines.append("# HELP " + metric + " " + text)
+        lines.append("# TYPE " + metric + " histogram")
+        for name, stats in sorted(ROUTES.items()):
+            lines += getattr(stats, attr).render(metric, pid + ',route="' + name + '"')
+    return "\n".join(lines) + "\n"
+
+class CountingWriter():
+    """ StreamWriter proxy counting the bytes written
+
+    The status code is picked from the Status line of the first write.
+    """
+    __slots__ = ("writer", "bytes_out", "status")
+    def __init__(self, writer):
+        self.writer = writer
+        self.bytes_out = 0
+        self.status = None
+    def __getattr__(self, name: str):
+        return getattr(self.writer, name)
+    def _status(self, data):
+        self.status = 0
+        if data[:8] == b"Status: ":
+            try:
+                self.status = int(bytes(data[8:11]))
+            except ValueError:
+                pass
+    def write(self, data):
+        "Write and count"
+        if self.status is None:
+            self._status(data)
+        self.bytes_out += len(data)
+        self.writer.write(data)
+    def writelines(self, data):
+        "Write and count"
+        data = list(data)
+        if self.status is None and data:
+            self._status(data[0])
+        self.bytes_out += sum(item.nbytes if isinstance(item, memoryview) else len(item) for item in data)
+        self.writer.writelines(data)
@@ -0,0 +1,245 @@
+#! /usr/bin/python3
+
+from . import error
+from . import lazy
+from . import offload
+from . import stream
+
+email_parser = lazy.module("email.parser")
+email_policy = lazy.module("email.policy")
+tempfile = lazy.module("tempfile")
+
+__doc__ = "Incremental multipart/form-data parser"
+
+## Parts larger than this move from memory to a temporary file
+SPOOL_SIZE = 1 << 20
+## Limit on the header block of a single part
+MAX_PART_HEAD = 1 << 14
+
+## Parser states
+PREAMBLE, BOUNDARY, HEADERS, BODY, DONE = range(5)
+
+class FormFile():
+    """ Uploaded form part backed by a spooled temporary file
+
+    Provides the parts of the CGIFile interface handlers use, plus file
+    style read and seek on the stored content.
+    """
+    def __init__(self, headers: "email.message.Message", spool_size: int = None):
+        self.headers = headers
+        self.file = tempfile.SpooledTemporaryFile(max_size = spool_size or SPOOL_SIZE)
+        self.size = 0
+    def __len__(self):
+        return self.size
+    def __repr__(self):
+        return "".join((
+            '<file name="',
+            self.get_param("name", header="content-disposition") or "None",
+            '" filename="',
+            self.get_filename() or "None",
+            '" size=',
+            str(len(self)),
+            ' />'
+        ))
+    def __getitem__(self, name: str):
+        return self.headers[name]
+    def __reduce__(self):
+        ## Pickled by content so a part can be handed to a process pool
+        return (_restore, (self.headers, self.get_payload()))
+    def get(self, name: str, failobj=None):
+        "Get a part header"
+        return self.headers.get(name, failobj)
+    def get_filename(self, failobj=None):
+        "Filename from Content-Disposition"
+        return self.headers.get_filename(failobj)
+    def get_param(self, param: str, failobj=None, header: str = "content-type"):
+        "Get a header parameter"
+        return self.headers.get_param(param, failobj, header)
+    def get_content_type(self) -> str:
+        "Content type of the part"
+        return self.headers.get_content_type()
+    def get_content_maintype(self) -> str:
+        "Main type of the part"
+        return self.headers.get_content_maintype()
+    def get_payload(self, decode: bool = False) -> bytes:
+        "Whole content of the part - This loads it into memory"
+        self.file.seek(0)
+        return self.file.read()
+    def write(self, data):
+        "Append data to the part"
+        self.file.write(data)
+        self.size += len(data)
+    def read(self, size: int = -1) -> bytes:
+        "Read from the part content"
+        return self.file.read(size)
+    def seek(self, offset: int, whence: int = 0) -> int:
+        "Move within the part content"
+        return self.file.seek(offset, whence)
+    def close(self):
+        "Release the storage"
+        self.file.close()
+
+def _restore(headers: "email.message.Message", payload: bytes) -> FormFile:
+    "Rebuild an unpickled FormFile"
+    result = FormFile(headers)
+    result.write(payload)
+    result.seek(0)
+    return result
+
+class MultipartParser():
+    """ Push parser for multipart bodies
+
+    feed() accepts the body in chunks of any size and keeps at most one
+    chunk plus the delimiter length buffered. close() returns the form.
+    """
+    def __init__(self, boundary: bytes, spool_size: int = None):
+        self.delimiter = b"\r\n--" + boundary
+        ## The first delimiter has no leading CRLF
+        self.buffer = bytearray(b"\r\n")
+        self.state = PREAMBLE
+        self.spool_size = spool_size or SPOOL_SIZE
+        self.part = None
+        self.parts = []
+
+    def feed(self, data: bytes):
+        "Parse the next chunk of the body"
+        buffer = self.buffer
+        buffer += data
+        while True:
+            if self.state == BODY:
+                idx = buffer.find(self.delimiter)
+                if idx < 0:
+                    ## Keep enough to match a delimiter split across chunks
+                    keep = len(buffer) - len(self.delimiter) + 1
+                    if keep > 0:
+                        self.part.write(buffer[:keep])
+                        del buffer[:keep]
+                    return
+                self.part.write(buffer[:idx])
+                del buffer[:idx + len(self.delimiter)]
+                self.part.file.seek(0)
+                self.parts.append(self.part)
+                self.part = None
+                self.state = BOUNDARY
+            elif self.state == HEADERS:
+                if buffer[:2] == b"\r\n":
+                    ## Part without header
+                    headers = b""
+                    del buffer[:2]
+                else:
+                    idx = buffer.find(b"\r\n\r\n")
+                    if idx < 0:
+                        if len(buffer) > MAX_PART_HEAD:
+                            raise error.ResponseError(400, "Multipart head too large")
+                        return
+                    headers = bytes(buffer[:idx])
+                    del buffer[:idx + 4]
+                self.part = FormFile(
+                    email_parser.BytesHeaderParser(policy = email_policy.HTTP).parsebytes(headers),
+                    self.spool_size
+                )
+                self.state = BODY
+            elif self.state == BOUNDARY:
+                if len(buffer) < 2:
+                    return
+                if buffer[:2] == b"--":
+                    self.state = DONE
+                    continue
+                ## Skip transport padding up to the line break
+                idx = buffer.find(b"\r\n")
+                if idx < 0:
+                    if len(buffer) > MAX_PART_HEAD:
+                        raise error.ResponseError(400, "Malformed multipart body")
+                    return
+                del buffer[:idx + 2]
+                self.state = HEADERS
+            elif self.state == PREAMBLE:
+                idx = buffer.find(self.delimiter)
+                if idx < 0:
+                    del buffer[:max(0, len(buffer) - len(self.delimiter) + 1)]
+                    return
+                del buffer[:idx + len(self.delimiter)]
+                self.state = BOUNDARY
+            else:
+                ## Epilogue is ignored
+                buffer.clear()
+                return
+
+    def abort(self):
+        "Drop every part stored so far"
+        for item in self.parts:
+            item.close()
+        if self.part is not None:
+            self.part.close()
+        self.parts = []
+        self.part = None
+
+    def close(self) -> dict:
+        "Finish parsing and return the form fields"
+        if self.state != DONE:
+            self.abort()
+            raise error.ResponseError(400, "Malformed multipart body")
+        result = {}
+        for item in self.parts:
+            name = item.get_param("name", header="content-disposition")
+            if name is None:
+                ## Not an entry to the form
+                item.close()
+                continue
+            if item.get_filename() is None and item.get_content_type() == "text/plain" \
+                    and len(item) <= self.spool_size:
+                ## A text field
+                try:
+                    result[name] = item.get_payload().decode("utf-8")
+                except UnicodeDecodeError:
+                    ## Cannot decode
+                    pass
+                item.close()
+            elif item.get_content_maintype() == "multipart":
+                ## Layered multipart, each file becomes an entry of a list
+                payload = self.parse_nested(item)
+                if payload:
+                    result[name] = payload
+            else:
+                ## This is a single attached file
+                result[name] = item
+        return result
+
+    def parse_nested(self, item: FormFile) -> list:
+        "Split a multipart/mixed part into its files"
+        boundary = item.get_param("boundary")
+        result = []
+        if boundary:
+            parser = MultipartParser(boundary.encode("latin-1"), self.spool_size)
+            for chunk in iter(lambda: item.read(stream.CHUNK_SIZE), b""):
+                parser.feed(chunk)
+            if parser.state == DONE:
+                for sub in parser.parts:
+                    if sub.get_content_maintype() == "multipart":
+                        ## Too many layers of multipart. Skip it.
+                        sub.close()
+                    else:
+                        result.append(sub)
+            else:
+                parser.abort()
+        item.close()
+        return result
+
+async def parse_formdata(header, body: stream.BodyReader) -> dict:
+    """ Parse a multipart/form-data body read from body """
+    boundary = header.get_param("boundary")
+    if not boundary:
+        raise error.ResponseError(400, "Missing multipart boundary")
+    parser = MultipartParser(boundary.encode("latin-1"))
+    offloaded = body.remaining > offload.PARSER_THRESHOLD
+    try:
+        async for chunk in body:
+            if offloaded:
+                ## Large uploads are scanned and spooled off the loop
+                await offload.run(offload.THREAD, parser.feed, chunk)
+            else:
+                parser.feed(chunk)
+    except BaseException:
+        parser.abort()
+        raise
+    return parser.close()
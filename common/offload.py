@@ -0,0 +1,100 @@
+#! /usr/bin/python3
+
+import asyncio
+import concurrent.futures
+import functools
+import importlib
+
+from . import field
+from . import output
+
+__doc__ = "Thread and process pools for CPU-bound or blocking work"
+
+THREAD, PROCESS = "thread", "process"
+## Pool sizes, None lets concurrent.futures pick from the CPU count
+THREAD_WORKERS = None
+PROCESS_WORKERS = None
+## Bodies above this size are parsed in PARSER_POOL instead of on the loop
+PARSER_THRESHOLD = 1 << 18
+PARSER_POOL = THREAD
+
+_POOLS = {}
+
+def pool(kind: str = THREAD) -> concurrent.futures.Executor:
+    "Return the executor of kind, creating it on first use"
+    executor = _POOLS.get(kind)
+    if executor is None:
+        if kind == THREAD:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                THREAD_WORKERS, thread_name_prefix = "offload"
+            )
+        elif kind == PROCESS:
+            executor = concurrent.futures.ProcessPoolExecutor(PROCESS_WORKERS)
+        else:
+            raise ValueError("Unknown pool " + repr(kind))
+        _POOLS[kind] = executor
+    return executor
+
+def shutdown(wait: bool = True):
+    "Stop every pool - They are recreated when used again"
+    while _POOLS:
+        _POOLS.popitem()[1].shutdown(wait = wait)
+
+def recycle_processes():
+    "Replace the process pool so new workers see reloaded modules"
+    executor = _POOLS.pop(PROCESS, None)
+    if executor is not None:
+        executor.shutdown(wait = False)
+
+def _invoke(module: str, qualname: str, args: tuple, kwargs: dict):
+    "Process pool entry - Resolve func by name as decorated ones cannot be pickled"
+    func = importlib.import_module(module)
+    for item in qualname.split("."):
+        func = getattr(func, item)
+    func = getattr(func, "__offload__", func)
+    return func(*args, **kwargs)
+
+async def run(kind: str, func, *args, **kwargs):
+    """ Call func(*args, **kwargs) in the pool of kind and await the result
+
+    For the process pool, func must be importable by name and the arguments
+    and result picklable.
+    """
+    loop = asyncio.get_running_loop()
+    if kind == PROCESS:
+        return await loop.run_in_executor(pool(PROCESS), _invoke, func.__module__, func.__qualname__, args, kwargs)
+    return await loop.run_in_executor(pool(kind), functools.partial(func, *args, **kwargs))
+
+async def run_parser(size: int, func, *args):
+    "Run a body parser inline when small, in PARSER_POOL otherwise"
+    if size <= PARSER_THRESHOLD:
+        return func(*args)
+    return await run(PARSER_POOL, func, *args)
+
+def handler(kind: str = THREAD):
+    """ Decorator turning a blocking main(header, data) into a handler
+
+    The body is parsed on the loop with common.parse_data, then main runs
+    in the pool of kind with the header and the form data. It returns a
+    Response, or a body sent with status 200. Handler modules may set
+    OFFLOAD = "thread" or "process" instead of using the decorator.
+    """
+    if kind not in (THREAD, PROCESS):
+        raise ValueError("Unknown pool " + repr(kind))
+    def decorate(func):
+        @functools.wraps(func)
+        async def main(header, stdin, stdout):
+            data = await field.parse_data(header, stdin)
+            try:
+                result = await run(kind, func, header, data)
+            finally:
+                for item in data.values():
+                    for entry in (item if isinstance(item, list) else (item,)):
+                        if hasattr(entry, "close"):
+                            entry.close()
+            if not isinstance(result, output.Response):
+                result = output.Response(body = result)
+            await output.send_response(header, stdout, result)
+        main.__offload__ = func
+        return main
+    return decorate
@@ -1,11 +1,30 @@
 #! /usr/bin/python3
 
 import asyncio
-import email.policy
 import http
+import os
+import stat
+import time
+
+from . import cache
+from . import compress
+from . import error
+from . import lazy
+from . import log
+from . import offload
+
+email_utils = lazy.module("email.utils")
+mimetypes = lazy.module("mimetypes")
 
 __doc__ = "Output Handler"
 
+SERVER_NAME = "StaphScgi v0.1"
+## Bytes read at once when the file cannot be sent with sendfile
+COPY_SIZE = 1 << 18
+## Seconds a file stat result is reused by send_file
+STAT_TTL = 1
+STAT_CACHE = cache.LRUCache(maxsize = 1024, ttl = STAT_TTL)
+
 def ignore_err(err):
     "Use this to ignore the error"
     def wrapper(fun):
@@ -13,10 +32,128 @@ def ignore_err(err):
             try:
                 fun(*args, **kwargs)
             except err:
-                print("Failed to write to the output")
+                log.warning("Failed to write to the output")
         return inner
     return wrapper
 
+def status_line(status: int) -> bytes:
+    "SCGI status line for the status code"
+    line = STATUS_LINES.get(status)
+    if line is None:
+        line = b"".join((
+            b"Status: ",
+            str(status).encode("ascii"),
+            b" ",
+            http.HTTPStatus(status).phrase.encode("ascii"),
+            b"\r\n"
+        ))
+    return line
+
+STATUS_LINES = {}
+STATUS_LINES.update({item.value: status_line(item.value) for item in http.HTTPStatus})
+
+class Response():
+    """ HTTP response kept as a list of buffers
+
+    Headers are (name, value) pairs so they may repeat. Body segments are
+    stored as given, memoryview included, and the whole response goes out
+    in a single writelines call.
+    """
+    __slots__ = ("status", "headers", "body")
+
+    def __init__(self, status: int = 200, headers=None, body=None):
+        self.status = status
+        self.headers = list(headers.items() if isinstance(headers, dict) else headers or ())
+        self.body = []
+        if body is not None:
+            self.write(body)
+
+    def __repr__(self) -> str:
+        return "".join(("<Response status=", str(self.status), " size=", str(len(self)), " />"))
+
+    def __len__(self) -> int:
+        "Body size in bytes"
+        return sum(item.nbytes if isinstance(item, memoryview) else len(item) for item in self.body)
+
+    def __bytes__(self) -> bytes:
+        return b"".join(self.buffers())
+
+    def __contains__(self, name: str) -> bool:
+        return self.get(name) is not None
+
+    def __getitem__(self, name: str):
+        return self.get(name)
+
+    def __setitem__(self, name: str, value: str):
+        self.set_header(name, value)
+
+    def get(self, name: str, default=None):
+        "Value of the first header with the name"
+        name = name.lower()
+        for item in self.headers:
+            if item[0].lower() == name:
+                return item[1]
+        return default
+
+    def add_header(self, name: str, value: str):
+        "Append a header, keeping existing ones with the same name"
+        self.headers.append((name, value))
+
+    def set_header(self, name: str, value: str):
+        "Replace every header with the name"
+        self.del_header(name)
+        self.headers.append((name, value))
+
+    def del_header(self, name: str):
+        "Drop every header with the name"
+        name = name.lower()
+        self.headers = [item for item in self.headers if item[0].lower() != name]
+
+    def write(self, data):
+        "Append a body segment - str is encoded as UTF-8"
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if data:
+            self.body.append(data)
+
+    def head(self) -> bytes:
+        "Status line and header block"
+        if self.body and "content-type" not in self:
+            self.headers.append(("Content-Type", "text/plain; charset=utf-8"))
+        if "x-server" not in self:
+            self.headers.append(("X-Server", SERVER_NAME))
+        return status_line(self.status) + "".join(
+            item[0] + ": " + item[1] + "\r\n" for item in self.headers
+        ).encode("latin-1") + b"\r\n"
+
+    def buffers(self) -> list:
+        "Everything to be sent, in order"
+        return [self.head()] + self.body
+
+    @classmethod
+    def from_message(cls, resp: "email.message.Message", status: int = 200):
+        "Convert an email.message.Message response"
+        result = cls(status, resp.items())
+        if resp.is_multipart():
+            ## Let the email generator lay out the parts
+            data = resp.as_bytes()
+            crlf, lf = data.find(b"\r\n\r\n"), data.find(b"\n\n")
+            result.write(data[crlf + 4:] if crlf >= 0 and (lf < 0 or crlf < lf) else data[lf + 2:])
+        elif "content-transfer-encoding" in resp:
+            result.write(resp.get_payload(decode=True))
+        else:
+            result.write(resp.get_payload().encode("utf-8", "surrogateescape"))
+        return result
+
+@ignore_err(ConnectionError)
+def write_response(req: dict, stdout: asyncio.streams.StreamWriter, resp: Response):
+    " Write the Response to stdout StreamWriter, compressing small bodies "
+    stdout.writelines(compress.encode_inline(req, resp).buffers())
+
+async def send_response(req: dict, stdout: asyncio.streams.StreamWriter, resp: Response):
+    " Write the Response to stdout, compressing large bodies in a thread "
+    write_response(req, stdout, await compress.encode(req, resp))
+
 @ignore_err(ConnectionError)
 def write_http(
     req: dict,
@@ -26,54 +163,234 @@ def write_http(
     body: bytes = b""
 ):
     " Write the response to stdout StreamWriter "
-    ## Sanity Check
-    ## For writes occurred before the header is parsed
-    if req is None:
-        req = {"REQUEST_METHOD": "GET"}
-    if header is None:
-        header = {}
-    if body and "Content-Type" not in header:
-        header["Content-Type"] = "text/plain; charset=utf-8"
-
-    ## Status Line
-    stdout.write(b" ".join((
-        b"Status:",
-        str(status).encode("ascii"),
-        http.HTTPStatus(status).phrase.encode("ascii")
-    )) + b"\r\n")
-    ## HTTP Header
-    stdout.write(b"\r\n".join((
-        item[0].encode("ascii") + b": " + item[1].encode("ascii") for item in header.items()
-    )))
-    stdout.write(b"\r\n\r\n")
-    ## HTTP Body
-    stdout.write(body)
+    stdout.writelines(Response(status, header, body).buffers())
 
 @ignore_err(ConnectionError)
 def write_email(
-    req: email.message.Message,
+    req: "email.message.Message",
     stdout: asyncio.streams.StreamWriter,
     status: int = 200,
-    resp: email.message.Message = None
+    resp: "email.message.Message" = None
 ):
-    " Write the response to stdout StreamWriter "
-    ## Sanity Check
-    ## For writes occurred before the header is parsed
-    if req is None:
-        req = {"REQUEST_METHOD": "GET"}
-    ## For blank resp
+    " Write an email.message.Message response - Compatibility shim over Response "
     if resp is None:
-        resp = email.message_from_string("\n", policy = email.policy.HTTP)
+        resp = Response(status)
+    else:
+        resp = Response.from_message(resp, status)
+    stdout.writelines(resp.buffers())
+
+def file_stat(path: str) -> os.stat_result:
+    "Stat the file, cached for STAT_TTL seconds"
+    result = STAT_CACHE.get(path)
+    if result is None:
+        result = os.stat(path)
+        STAT_CACHE.put(path, result)
+    return result
+
+def file_etag(info: os.stat_result) -> str:
+    "Strong ETag from modification time and size"
+    return '"' + format(info.st_mtime_ns, "x") + "-" + format(info.st_size, "x") + '"'
+
+def not_modified(req, etag: str, mtime: float) -> bool:
+    "Evaluate If-None-Match and If-Modified-Since"
+    match = req.get("HTTP_IF_NONE_MATCH")
+    if match is not None:
+        match = [item.strip() for item in match.split(",")]
+        return "*" in match or etag in match or "W/" + etag in match
+    since = req.get("HTTP_IF_MODIFIED_SINCE")
+    if since:
+        try:
+            return int(mtime) <= email_utils.parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def parse_range(req, size: int, etag: str, mtime: float):
+    "Return (start, end) of a satisfiable single byte range, None for the whole file"
+    value = req.get("HTTP_RANGE")
+    if not value or not value.startswith("bytes=") or "," in value:
+        ## Absent, or multiple ranges which we answer with the whole file
+        return None
+    condition = req.get("HTTP_IF_RANGE")
+    if condition and condition != etag:
+        try:
+            if email_utils.parsedate_to_datetime(condition).timestamp() < int(mtime):
+                return None
+        except (TypeError, ValueError):
+            return None
+    first, sep, last = value[6:].strip().partition("-")
+    ## An invalid range is ignored, only valid ones past the end get 416
+    try:
+        if not sep or not (first + last).isdigit():
+            raise ValueError(value)
+        if first:
+            start = int(first)
+            if last and int(last) < start:
+                raise ValueError(value)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            ## Suffix range - the last bytes of the file
+            start, end = max(size - int(last), 0), size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise error.ResponseError(416, headers = {"Content-Range": "bytes */" + str(size)})
+    return start, end
+
+async def send_file(
+    req,
+    stdout: asyncio.streams.StreamWriter,
+    path: str,
+    headers: dict = None,
+    content_type: str = None
+):
+    """ Send the file with sendfile on the transport, never loading it into memory
+
+    Handles HEAD, conditional requests with 304 and single Range requests
+    with 206. Raises ResponseError 404 when there is no such file. Writers
+    without a transport, like FastCGI ones, and loops without sendfile,
+    like uvloop, get it in COPY_SIZE chunks.
+    """
+    try:
+        info = file_stat(path)
+    except (FileNotFoundError, NotADirectoryError) as err:
+        raise error.ResponseError(404, "File not found") from err
+    if not stat.S_ISREG(info.st_mode):
+        raise error.ResponseError(404, "File not found")
+    etag = file_etag(info)
+    resp = Response(200, headers)
+    if "content-type" not in resp:
+        resp.set_header("Content-Type", content_type or mimetypes.guess_type(path)[0] or "application/octet-stream")
+    encoding = None
+    if compress.eligible(resp["Content-Type"]):
+        resp.set_header("Vary", "Accept-Encoding")
+        ## HEAD is negotiated like GET so that its headers match
+        if req.get("REQUEST_METHOD") in ("GET", "HEAD") and not req.get("HTTP_RANGE") \
+                and info.st_size >= compress.MIN_SIZE:
+            encoding = compress.negotiate(req.get("HTTP_ACCEPT_ENCODING"))
+            if encoding is not None:
+                etag = compress.variant_etag(etag, encoding)
+    resp.set_header("ETag", etag)
+    resp.set_header("Last-Modified", email_utils.formatdate(info.st_mtime, usegmt=True))
+    if not_modified(req, etag, info.st_mtime):
+        resp.status = 304
+        write_response(req, stdout, resp)
+        return
+    if encoding is not None:
+        await send_compressed(req, stdout, path, resp, encoding)
+        return
+    resp.set_header("Accept-Ranges", "bytes")
+    offset, count = 0, info.st_size
+    span = parse_range(req, info.st_size, etag, info.st_mtime)
+    if span is not None:
+        resp.status = 206
+        resp.set_header("Content-Range", "bytes " + str(span[0]) + "-" + str(span[1]) + "/" + str(info.st_size))
+        offset, count = span[0], span[1] - span[0] + 1
+    resp.set_header("Content-Length", str(count))
+    write_response(req, stdout, resp)
+    if req.get("REQUEST_METHOD") == "HEAD" or not count:
+        return
+    transport = getattr(stdout, "transport", None)
+    with open(path, "rb") as fin:
+        await stdout.drain()
+        if transport is not None:
+            try:
+                sent = await asyncio.get_running_loop().sendfile(transport, fin, offset, count)
+            except (NotImplementedError, asyncio.SendfileNotAvailableError):
+                ## Raised before anything was sent, the headers alone are out
+                pass
+            else:
+                if hasattr(stdout, "bytes_out"):
+                    ## Bypassed the writer, so account for it here
+                    stdout.bytes_out += sent
+                return
+        await copy_file(stdout, fin, offset, count)
+
+async def copy_file(stdout: asyncio.streams.StreamWriter, fin, offset: int, count: int):
+    "Write count bytes of fin from offset through stdout, reading off the loop"
+    fin.seek(offset)
+    while count > 0:
+        data = await offload.run(offload.THREAD, fin.read, min(count, COPY_SIZE))
+        if not data:
+            break
+        stdout.write(data)
+        await stdout.drain()
+        count -= len(data)
+
+async def send_compressed(req, stdout: asyncio.streams.StreamWriter, path: str, resp: Response, encoding: str):
+    """ Send the file compressed with encoding
+
+    Files up to compress.CACHE_ENTRY_SIZE are compressed whole in a thread
+    and cached by ETag. Larger ones are compressed chunk by chunk as they
+    are written, without Content-Length. HEAD gets the same headers alone.
+    """
+    head = req.get("REQUEST_METHOD") == "HEAD"
+    etag = resp["ETag"]
+    body = compress.CACHE.get((etag, encoding))
+    if body is None and file_stat(path).st_size <= compress.CACHE_ENTRY_SIZE:
+        body = await offload.run(offload.THREAD, compress.compress_file, path, encoding)
+        compress.CACHE.put((etag, encoding), body)
+    resp.set_header("Content-Encoding", encoding)
+    if body is not None:
+        resp.body = list(body)
+        resp.set_header("Content-Length", str(len(resp)))
+        if head:
+            resp.body = []
+        write_response(req, stdout, resp)
+        return
+    write_response(req, stdout, resp)
+    if head:
+        return
+    engine = compress.compressor(encoding)
+    with open(path, "rb") as fin:
+        done = False
+        while not done:
+            data, done = await offload.run(offload.THREAD, compress.read_compressed, fin, engine)
+            stdout.write(data)
+            await stdout.drain()
+
+def _write_email_legacy(req, stdout, status: int = 200, resp: "email.message.Message" = None):
+    "Previous email serialization, kept for benchmarking"
     if resp.get_payload() and resp.get("content-type") is None:
         resp["Content-Type"] = "text/plain; charset=utf-8"
     if resp.get("x-server") is None:
         resp["X-Server"] = "StaphScgi-Email v0.1"
-
-    ## Status Line
     stdout.write(b" ".join((
         b"Status:",
         str(status).encode("ascii"),
         http.HTTPStatus(status).phrase.encode("ascii")
     )) + b"\r\n")
-    ## HTTP Response
     stdout.write(bytes(resp))
+
+class _NullWriter():
+    "Stand-in StreamWriter that drops the output"
+    size = 0
+    def write(self, data):
+        self.size += len(data)
+    def writelines(self, data):
+        for item in data:
+            self.size += len(item)
+
+def benchmark(duration: float = 1):
+    "Compare responses per second of Response against the email path"
+    import email.policy #pylint: disable=import-outside-toplevel
+    for name, size in (("small", 13), ("large", 1 << 20)):
+        body = b"x" * (size - 1) + b"\n"
+        cases = (
+            ("email", lambda: _write_email_legacy(None, _NullWriter(), 200, email.message_from_bytes(
+                b"Content-Type: text/plain; charset=utf-8\n\n" + body, policy = email.policy.HTTP
+            ))),
+            ("response", lambda: write_response(None, _NullWriter(), Response(
+                200, {"Content-Type": "text/plain; charset=utf-8"}, memoryview(body)
+            )))
+        )
+        for case, fun in cases:
+            done = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < duration:
+                fun()
+                done += 1
+            print(
+                name.ljust(6), case.ljust(9),
+                str(int(done / (time.perf_counter() - start))).rjust(9), "resp/s"
+            )
@@ -0,0 +1,279 @@
+#! /usr/bin/python3
+
+import asyncio
+import bisect
+import os
+import socket
+import time
+
+from . import lazy
+from . import log
+from . import offload
+
+## For the benchmark only
+ipaddress = lazy.module("ipaddress")
+random = lazy.module("random")
+
+__doc__ = "Longest prefix match of IPv4 and IPv6 addresses against tagged networks"
+
+## Networks for which ipaddress reports is_private, IPv4-mapped addresses aside
+PRIVATE_NETWORKS = (
+    "0.0.0.0/8", "10.0.0.0/8", "127.0.0.0/8", "169.254.0.0/16", "172.16.0.0/12",
+    "192.0.0.0/29", "192.0.0.170/31", "192.0.2.0/24", "192.168.0.0/16", "198.18.0.0/15",
+    "198.51.100.0/24", "203.0.113.0/24", "240.0.0.0/4", "255.255.255.255/32",
+    "::1/128", "::/128", "100::/64", "2001::/23", "2001:2::/48", "2001:db8::/32",
+    "2001:10::/28", "fc00::/7", "fe80::/10"
+)
+LOOPBACK_NETWORKS = ("127.0.0.0/8", "::1/128")
+## Prefix file loaded by PrefixFile when none is given, set from config.ini
+FILE = ""
+## Seconds between checks of the file for changes
+CHECK_INTERVAL = 5
+
+def parse_address(addr: str) -> tuple:
+    """ (version, integer) of an address, ValueError when malformed
+
+    IPv4-mapped IPv6 addresses are returned as IPv4.
+    """
+    try:
+        if ":" in addr:
+            value = int.from_bytes(socket.inet_pton(socket.AF_INET6, addr.split("%", 1)[0]), "big")
+            if value >> 32 == 0xffff:
+                return 4, value & 0xffffffff
+            return 6, value
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, addr), "big")
+    except OSError as err:
+        raise ValueError("Malformed address " + repr(addr)) from err
+
+def parse_network(network) -> tuple:
+    """ (version, first, last, text) of a network string or ipaddress network
+
+    Host bits are ignored and a missing length means a single address.
+    Raises ValueError when malformed. A tuple is taken as already parsed.
+    """
+    if isinstance(network, tuple):
+        return network
+    if not isinstance(network, str):
+        return (
+            network.version, int(network.network_address),
+            int(network.broadcast_address), str(network)
+        )
+    addr, _, length = network.strip().partition("/")
+    if ":" in addr:
+        version, bits, family = 6, 128, socket.AF_INET6
+    else:
+        version, bits, family = 4, 32, socket.AF_INET
+    try:
+        value = int.from_bytes(socket.inet_pton(family, addr), "big")
+        length = int(length) if length else bits
+    except (OSError, ValueError) as err:
+        raise ValueError("Malformed network " + repr(network)) from err
+    if not 0 <= length <= bits:
+        raise ValueError("Malformed network " + repr(network))
+    host = (1 << (bits - length)) - 1
+    value &= ~host
+    text = socket.inet_ntop(family, value.to_bytes(bits >> 3, "big")) + "/" + str(length)
+    return version, value, value | host, text
+
+def _flatten(items: list) -> tuple:
+    """ Disjoint (starts, ends, values) of nested (start, end, value) ranges
+
+    Every address range is attributed to the most specific range covering
+    it, which turns longest prefix match into a single bisect.
+    """
+    starts, ends, values = [], [], []
+    def emit(start, end, value):
+        if values and values[-1] is value and ends[-1] + 1 == start:
+            ends[-1] = end
+        else:
+            starts.append(start)
+            ends.append(end)
+            values.append(value)
+    stack = []
+    cursor = 0
+    for start, end, value in sorted(items, key = lambda item: (item[0], -item[1])):
+        ## Finish the enclosing ranges that end before this one
+        while stack and stack[-1][0] < start:
+            top_end, top_value = stack.pop()
+            if cursor <= top_end:
+                emit(cursor, top_end, top_value)
+                cursor = top_end + 1
+        if stack and cursor < start:
+            emit(cursor, start - 1, stack[-1][1])
+        cursor = start
+        stack.append((end, value))
+    while stack:
+        top_end, top_value = stack.pop()
+        if cursor <= top_end:
+            emit(cursor, top_end, top_value)
+            cursor = top_end + 1
+    return starts, ends, values
+
+class PrefixIndex():
+    """ Immutable index of networks with a tag each
+
+    Built from (network, tag) pairs, where network is a string or an
+    ipaddress network. A network listed twice keeps the last tag. Lookups
+    find the most specific network containing the address with one
+    bisect over disjoint address intervals, per IP version.
+    """
+    __slots__ = ("size", "_tables")
+    def __init__(self, prefixes=()):
+        networks = {}
+        for network, tag in prefixes:
+            version, first, last, text = parse_network(network)
+            networks[(version, first, last)] = (text, tag)
+        self.size = len(networks)
+        ranges = {4: [], 6: []}
+        for (version, first, last), value in networks.items():
+            ranges[version].append((first, last, value))
+        self._tables = {version: _flatten(items) for version, items in ranges.items()}
+    def __repr__(self) -> str:
+        return "<PrefixIndex prefixes=" + str(self.size) + " />"
+    def __len__(self) -> int:
+        return self.size
+    def __contains__(self, addr: str) -> bool:
+        return self.match(addr) is not None
+
+    @classmethod
+    def from_file(cls, path: str, tag: str = "listed", base=()):
+        """ Build from a file of "network [tag]" lines
+
+        # starts a comment. Lines without a tag use tag. Networks of the
+        file override the same networks in base.
+        """
+        prefixes = list(base)
+        with open(path, encoding = "utf-8") as fin:
+            for number, line in enumerate(fin, 1):
+                line = line.split("#", 1)[0].split()
+                if not line:
+                    continue
+                try:
+                    prefixes.append((parse_network(line[0]), line[1] if len(line) > 1 else tag))
+                except ValueError as err:
+                    raise ValueError(path + ":" + str(number) + ": " + str(err)) from err
+        return cls(prefixes)
+
+    def match(self, addr: str):
+        "(network, tag) of the most specific network containing addr, None otherwise"
+        try:
+            version, value = parse_address(addr)
+        except ValueError:
+            return None
+        starts, ends, values = self._tables[version]
+        pos = bisect.bisect_right(starts, value) - 1
+        if pos >= 0 and value <= ends[pos]:
+            return values[pos]
+        return None
+    def lookup(self, addr: str, default=None):
+        "Tag of the most specific network containing addr, default otherwise"
+        result = self.match(addr)
+        return default if result is None else result[1]
+
+class PrefixFile():
+    """ PrefixIndex of base plus a prefix file, rebuilt when the file changes
+
+    The file mtime is checked at most every check_interval seconds. With
+    a running loop the rebuild happens in the offload thread pool while
+    lookups keep using the previous index. A file that fails to load is
+    logged and leaves the index as it was.
+    """
+    def __init__(self, path: str = None, tag: str = "listed", base=(), check_interval: float = None):
+        self.path = path
+        self.tag = tag
+        self.base = list(base)
+        self.check_interval = check_interval
+        self._index = PrefixIndex(self.base)
+        self._mtime = None
+        self._checked = None
+        self._pending = None
+    def __repr__(self) -> str:
+        return '<PrefixFile path="' + str(self.path or FILE) + '" prefixes=' + str(len(self._index)) + " />"
+
+    def _load(self, path: str, mtime: int):
+        try:
+            index = PrefixIndex.from_file(path, self.tag, self.base) if mtime is not None else PrefixIndex(self.base)
+        except (OSError, ValueError) as err:
+            log.warning("Keeping previous prefixes:", err)
+            return
+        self._index = index
+        if mtime is not None:
+            log.info("Loaded", len(index), "prefixes from", path)
+    def _loaded(self, _):
+        self._pending = None
+
+    def index(self) -> PrefixIndex:
+        "Return the current index, starting a rebuild if the file changed"
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < (self.check_interval or CHECK_INTERVAL):
+            return self._index
+        self._checked = now
+        path = self.path or FILE
+        try:
+            mtime = os.stat(path).st_mtime_ns if path else None
+        except OSError:
+            mtime = None
+        if mtime == self._mtime or self._pending is not None:
+            return self._index
+        self._mtime = mtime
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None or mtime is None:
+            self._load(path, mtime)
+        else:
+            self._pending = loop.run_in_executor(offload.pool(offload.THREAD), self._load, path, mtime)
+            self._pending.add_done_callback(self._loaded)
+        return self._index
+    def match(self, addr: str):
+        "See PrefixIndex.match"
+        return self.index().match(addr)
+    def lookup(self, addr: str, default=None):
+        "See PrefixIndex.lookup"
+        return self.index().lookup(addr, default)
+
+def _random_prefixes(count: int, rng) -> list:
+    "count random networks, a quarter of them IPv6, with nested ones among them"
+    result = []
+    for _ in range(count):
+        if rng.random() < 0.25:
+            length = rng.randint(24, 64)
+            address = ipaddress.IPv6Address(rng.getrandbits(128))
+        else:
+            length = rng.randint(8, 30)
+            address = ipaddress.IPv4Address(rng.getrandbits(32))
+        result.append((ipaddress.ip_network(str(address) + "/" + str(length), strict = False), "tag" + str(length)))
+    return result
+
+def benchmark(duration: float = 1):
+    "Build time and lookups per second at 10k and 100k prefixes against a linear scan"
+    rng = random.Random(42)
+    for count in (10000, 100000):
+        prefixes = _random_prefixes(count, rng)
+        start = time.perf_counter()
+        index = PrefixIndex(prefixes)
+        built = time.perf_counter() - start
+        addresses = [str(ipaddress.IPv4Address(rng.getrandbits(32))) for _ in range(750)] \
+            + [str(item[0].network_address + 1) for item in prefixes[:250]]
+        cases = [("index", lambda addr: index.lookup(addr))]
+        networks = [item[0] for item in prefixes]
+        def scan(addr):
+            numip = ipaddress.ip_address(addr)
+            best = None
+            for item in networks:
+                if numip in item and (best is None or item.prefixlen > best.prefixlen):
+                    best = item
+            return best
+        cases.append(("scan", scan))
+        for case, fun in cases:
+            done = 0
+            start = time.perf_counter()
+            while not done or time.perf_counter() - start < duration:
+                fun(addresses[done % len(addresses)])
+                done += 1
+            print(
+                str(count).rjust(7), "prefixes", case.ljust(6),
+                str(int(done / (time.perf_counter() - start))).rjust(9), "lookups/s",
+                ("build %.0f ms" % (built * 1000)) if case == "index" else ""
+            )
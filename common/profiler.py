@@ -0,0 +1,206 @@
+#! /usr/bin/python3
+
+import collections
+import os
+import sys
+import threading
+import time
+
+from . import log
+
+__doc__ = "Sampling profiler of route handlers - Collapsed stacks for flame graphs"
+
+## Seconds between samples
+INTERVAL = 0.005
+## Profile one request in this many per route, 0 for none
+EVERY = 100
+## Also keep every request slower than this many seconds, 0 for none
+THRESHOLD = 0
+## Collapsed stacks written when stopping, {pid} is replaced by the process id
+OUTPUT = ""
+## Leaf of the stacks sampled while the handler awaits
+WAITING = "[waiting]"
+
+## The running profiler, None otherwise - The only thing the request path checks
+ACTIVE = None
+
+_LABELS = {}
+
+def label(code) -> str:
+    "Flame graph frame name of a code object"
+    result = _LABELS.get(code)
+    if result is None:
+        result = _LABELS[code] = (
+            getattr(code, "co_qualname", code.co_name)
+            + " (" + os.path.basename(code.co_filename) + ":" + str(code.co_firstlineno) + ")"
+        )
+    return result
+
+def awaiting(coro) -> list:
+    "Frames of a suspended coroutine down the chain it awaits, outermost first"
+    result = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        result.append(frame)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return result
+
+class Trace():
+    " Stacks sampled from one request "
+    __slots__ = ("route", "coro", "stacks")
+    def __init__(self, route: str, coro):
+        self.route = route
+        self.coro = coro
+        self.stacks = collections.Counter()
+    def add(self, frames: list, waiting: bool):
+        "Count one sample of frames, outermost first"
+        stack = [self.route]
+        stack += (label(frame.f_code) for frame in frames)
+        if waiting:
+            stack.append(WAITING)
+        self.stacks[";".join(stack)] += 1
+
+class Profiler():
+    """ Samples the stacks of the requests it runs from a background thread
+
+    Requests are picked one in every per route, and all of them when a
+    threshold is set so that slow ones can be kept once they finish. Each
+    sample records where a picked request is: running on the loop, or the
+    chain of coroutines it awaits in, so the flame graph shows wall time.
+    Stacks of requests that were neither picked nor slow are dropped.
+    """
+    def __init__(self, every: int = None, threshold: float = None, interval: float = None):
+        self.every = EVERY if every is None else every
+        self.threshold = THRESHOLD if threshold is None else threshold
+        self.interval = interval or INTERVAL
+        self.stacks = collections.Counter()
+        self.requests = 0
+        self.samples = 0
+        self._counts = {}
+        ## Frame of run for each traced request - Marks where its stack starts
+        self._traces = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._loop_thread = None
+    def __repr__(self) -> str:
+        return (
+            "<Profiler every=" + str(self.every) + " threshold=" + str(self.threshold)
+            + " requests=" + str(self.requests) + " samples=" + str(self.samples) + " />"
+        )
+
+    def start(self):
+        "Start sampling - Call from the thread running the loop"
+        if self._thread is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._sample, name = "profiler", daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        "Stop sampling, the stacks collected so far are kept"
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def clear(self):
+        "Forget the stacks collected so far"
+        with self._lock:
+            self.stacks.clear()
+            self.requests = self.samples = 0
+            self._counts.clear()
+
+    def collapsed(self) -> str:
+        "Stacks in the collapsed format of flamegraph.pl, one \"frames count\" per line"
+        with self._lock:
+            return "".join(stack + " " + str(count) + "\n" for stack, count in sorted(self.stacks.items()))
+
+    def write(self, path: str):
+        "Write the collapsed stacks to path"
+        with open(path, "w", encoding = "utf-8") as fout:
+            fout.write(self.collapsed())
+
+    async def run(self, route: str, coro):
+        "Await the handler coroutine of route, tracing it when picked"
+        count = self._counts.get(route, 0)
+        self._counts[route] = count + 1
+        picked = bool(self.every) and count % self.every == 0
+        if not picked and not self.threshold:
+            return await coro
+        trace = Trace(route, coro)
+        frame = sys._getframe() #pylint: disable=protected-access
+        ## The sampler thread walks _traces under the lock
+        with self._lock:
+            self._traces[frame] = trace
+        started = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                del self._traces[frame]
+                if picked or (self.threshold and elapsed >= self.threshold):
+                    self.requests += 1
+                    self.stacks.update(trace.stacks)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                if not self._traces:
+                    continue
+                running = None
+                frames = []
+                frame = sys._current_frames().get(self._loop_thread) #pylint: disable=protected-access
+                while frame is not None:
+                    running = self._traces.get(frame)
+                    if running is not None:
+                        break
+                    frames.append(frame)
+                    frame = frame.f_back
+                frames.reverse()
+                for trace in self._traces.values():
+                    if trace is running:
+                        trace.add(frames, False)
+                    else:
+                        trace.add(awaiting(trace.coro), True)
+                    self.samples += 1
+
+PROFILER = Profiler()
+
+def start(every: int = None, threshold: float = None, interval: float = None):
+    "Start profiling the requests of this process with a fresh profiler"
+    global ACTIVE, PROFILER #pylint: disable=global-statement
+    if ACTIVE is not None:
+        return
+    PROFILER = Profiler(every, threshold, interval)
+    PROFILER.start()
+    ACTIVE = PROFILER
+    log.info("Profiling", PROFILER)
+
+def stop():
+    "Stop profiling and write the stacks to OUTPUT when set"
+    global ACTIVE #pylint: disable=global-statement
+    if ACTIVE is None:
+        return
+    ACTIVE = None
+    PROFILER.stop()
+    path = OUTPUT.replace("{pid}", str(os.getpid()))
+    if path:
+        try:
+            PROFILER.write(path)
+        except OSError as err:
+            log.warning("Cannot write profile:", err)
+            path = ""
+    log.info("Profiled", PROFILER, path and "to " + path)
+
+def toggle():
+    "Start profiling when stopped, stop it when running"
+    if ACTIVE is None:
+        start()
+    else:
+        stop()
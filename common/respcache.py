@@ -0,0 +1,116 @@
+#! /usr/bin/python3
+
+import asyncio
+import functools
+
+from . import cache
+from . import compress
+
+__doc__ = "Cache of serialized handler responses for GET and HEAD"
+
+## Responses larger than this are never cached
+MAX_ENTRY = 1 << 20
+## Serialized responses of every route together, by key
+CACHE = cache.LRUCache(maxsize = 4096, maxbytes = 1 << 26)
+## Keys with a handler running, followers await its future
+_PENDING = {}
+
+class CaptureWriter():
+    """ StreamWriter proxy keeping what the handler writes
+
+    Everything else, like drain, goes to the wrapped writer. transport is
+    hidden so that send_file writes the file through the capture instead
+    of sending it on the socket ahead of the captured headers.
+    """
+    __slots__ = ("writer", "data")
+    transport = None
+    def __init__(self, writer):
+        self.writer = writer
+        self.data = []
+    def __getattr__(self, name: str):
+        return getattr(self.writer, name)
+    def write(self, data):
+        "Keep data"
+        self.data.append(bytes(data))
+    def writelines(self, data):
+        "Keep every buffer of data"
+        self.data.extend(bytes(item) for item in data)
+    def getvalue(self) -> bytes:
+        "Everything written so far"
+        return b"".join(self.data)
+
+def normalize_query(query: str) -> str:
+    "Query string with its fields in a stable order"
+    return "&".join(sorted(item for item in query.split("&") if item)) if query else ""
+
+def cache_key(header, vary) -> tuple:
+    """ Key of the request, None when it must not be served from cache
+
+    vary is a tuple of header variable names whose values are part of the
+    key, or a function of the header returning such values or None.
+    """
+    if callable(vary):
+        vary = vary(header)
+        if vary is None:
+            return None
+    else:
+        vary = tuple(header.get(item) for item in vary)
+    return (
+        header["REQUEST_METHOD"],
+        header["DOCUMENT_URI"],
+        normalize_query(header.get("QUERY_STRING")),
+        ## The same body is compressed differently per negotiated encoding
+        compress.negotiate(header.get("HTTP_ACCEPT_ENCODING")),
+        vary
+    )
+
+def cacheable(data: bytes) -> bool:
+    "Whether the serialized response may be shared"
+    if not data.startswith(b"Status: 200 ") or len(data) > MAX_ENTRY:
+        return False
+    head = data[:data.find(b"\r\n\r\n")].lower()
+    return b"\nset-cookie:" not in head and b"no-store" not in head and b"private" not in head
+
+def cached(func, ttl: float, vary=()):
+    """ Wrap a handler so its GET and HEAD responses are cached for ttl seconds
+
+    Concurrent misses of the same key run the handler once, the other
+    requests wait for its response.
+    """
+    @functools.wraps(func)
+    async def main(header, stdin, stdout):
+        if header["REQUEST_METHOD"] not in ("GET", "HEAD"):
+            return await func(header, stdin, stdout)
+        key = cache_key(header, vary)
+        if key is None:
+            return await func(header, stdin, stdout)
+        data = CACHE.get(key)
+        pending = _PENDING.get(key)
+        while data is None and pending is not None:
+            ## Shielded so a follower going away leaves the leader alone
+            data = await asyncio.shield(pending)
+            ## After an uncacheable response, the first follower to wake leads
+            pending = _PENDING.get(key)
+        if data is not None:
+            stdout.write(data)
+            return None
+        future = asyncio.get_running_loop().create_future()
+        _PENDING[key] = future
+        capture = CaptureWriter(stdout)
+        data = None
+        try:
+            result = await func(header, stdin, capture)
+            data = capture.getvalue()
+            if cacheable(data):
+                CACHE.put(key, data, ttl, len(data))
+            else:
+                data = None
+        finally:
+            try:
+                if _PENDING.get(key) is future:
+                    del _PENDING[key]
+            finally:
+                future.set_result(data)
+                stdout.writelines(capture.data)
+        return result
+    return main
@@ -0,0 +1,133 @@
+#! /usr/bin/python3
+
+import importlib
+import importlib.machinery
+import importlib.util
+import os
+import sys
+import types
+
+from . import log
+from . import offload
+from . import respcache
+
+__doc__ = "Route table mapping handler module names to their main"
+
+def load(name: str):
+    """ Execute a fresh copy of the module name from its source
+
+    The new module replaces the old one in sys.modules only once it ran
+    without error. The source is compiled directly, as cached bytecode
+    only notices changes to the second. Names listed in RELOAD_KEEP of
+    the new module are carried over from the old one.
+    """
+    previous = sys.modules.get(name)
+    spec = importlib.machinery.PathFinder.find_spec(name)
+    if spec is None or not isinstance(spec.loader, importlib.machinery.SourceFileLoader):
+        raise ImportError("No source for module " + name, name = name)
+    module = importlib.util.module_from_spec(spec)
+    code = spec.loader.source_to_code(spec.loader.get_data(spec.origin), spec.origin)
+    sys.modules[name] = module
+    try:
+        exec(code, module.__dict__) #pylint: disable=exec-used
+    except BaseException:
+        if previous is not None:
+            sys.modules[name] = previous
+        else:
+            del sys.modules[name]
+        raise
+    for item in getattr(module, "RELOAD_KEEP", ()):
+        if previous is not None and hasattr(previous, item):
+            setattr(module, item, getattr(previous, item))
+    return module
+
+class Router():
+    """ Immutable route table built ahead of serving
+
+    Handlers are the modules listed in preload, or every module and package
+    found in root when preload is empty, that define a callable main.
+    A module setting OFFLOAD to "thread" or "process" has a blocking
+    main(header, data) wrapped with offload.handler. A module setting
+    CACHE_TTL, or listed in cache_ttl, has its GET responses cached for
+    that many seconds, varying on CACHE_VARY (see respcache.cache_key).
+    The table is only replaced as a whole by reload(), so requests already
+    running finish on the handler they started with.
+    """
+    def __init__(self, root: str = ".", preload: list = None, exclude: list = (), cache_ttl: dict = None):
+        self.root = root
+        self.preload = list(preload or ())
+        self.exclude = set(exclude)
+        self.cache_ttl = dict(cache_ttl or {})
+        self.table = types.MappingProxyType({})
+        ## Handler modules by name, as loaded for the current table
+        self.modules = {}
+    def __repr__(self) -> str:
+        return '<Router root="' + self.root + '" routes="' + ",".join(sorted(self.table)) + '" />'
+    def __contains__(self, name: str) -> bool:
+        return name in self.table
+    def get(self, name: str):
+        "Return the handler for the module name, or None"
+        return self.table.get(name)
+    def scan(self) -> list:
+        "Names of the modules and packages in root"
+        result = []
+        for item in sorted(os.listdir(self.root)):
+            if item.endswith(".py") and os.path.isfile(os.path.join(self.root, item)):
+                item = item[:-3]
+            elif not os.path.isdir(os.path.join(self.root, item)):
+                continue
+            if item.isidentifier() and not item.startswith("_") and item not in self.exclude:
+                result.append(item)
+        return result
+    def sources(self) -> dict:
+        "Module names of the handlers by source file"
+        return {
+            os.path.abspath(module.__file__): name
+            for name, module in self.modules.items() if getattr(module, "__file__", None)
+        }
+    def build(self, names=None) -> dict:
+        """ Import the handler modules and return the new table
+
+        Handlers in names, every one when None, are loaded afresh from
+        their source. A handler failing to load keeps its current route.
+        """
+        table = {}
+        modules = {}
+        importlib.invalidate_caches()
+        for name in self.preload or self.scan():
+            previous = self.modules.get(name)
+            try:
+                if previous is not None and (names is None or name in names):
+                    target = load(name)
+                    log.info("Reloaded handler", name)
+                else:
+                    target = importlib.import_module(name)
+            except Exception: #pylint: disable=broad-except
+                log.exception("Failed to load handler", name)
+                if name in self.table:
+                    table[name], modules[name] = self.table[name], previous
+                continue
+            if target is previous and name in self.table:
+                table[name], modules[name] = self.table[name], previous
+                continue
+            main = getattr(target, "main", None)
+            if not callable(main):
+                continue
+            if getattr(target, "OFFLOAD", None) and not hasattr(main, "__offload__"):
+                try:
+                    main = offload.handler(target.OFFLOAD)(main)
+                except ValueError:
+                    log.exception("Bad OFFLOAD in handler", name)
+                    continue
+            ttl = self.cache_ttl.get(name, getattr(target, "CACHE_TTL", None))
+            if ttl:
+                main = respcache.cached(main, ttl, getattr(target, "CACHE_VARY", ()))
+            table[name], modules[name] = main, target
+        self.modules = modules
+        return table
+    def reload(self, names=None):
+        "Rebuild the table, reloading the handlers in names or all, and swap it in"
+        self.table = types.MappingProxyType(self.build(names))
+        ## Responses cached from replaced handlers are stale
+        respcache.CACHE.clear()
+        log.info("Routes:", ", ".join(sorted(self.table)))
@@ -1,14 +1,109 @@
 #! /usr/bin/python3
 
 import asyncio
+import os
+import socket
+import stat
+import time
+
+from . import lazy
+from . import log
+
+uvloop = lazy.module("uvloop")
 
 __doc__ = "Server Config Definitions for starting"
 
+AUTO, UVLOOP, ASYNCIO = "auto", "uvloop", "asyncio"
+SCGI, FASTCGI = "scgi", "fastcgi"
+## StreamReader buffer limit - readuntil fails beyond it, reading pauses at twice
+STREAM_LIMIT = 1 << 16
+
+def use_loop(kind: str = AUTO) -> str:
+    """ Install the event loop policy of kind and return the one in use
+
+    AUTO takes uvloop when installed. Asking for uvloop without it falls
+    back to asyncio with a warning.
+    """
+    if kind in (AUTO, UVLOOP):
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return UVLOOP
+        if kind == UVLOOP:
+            log.warning("uvloop is not installed, using asyncio")
+    elif kind != ASYNCIO:
+        raise ValueError("Unknown event loop " + repr(kind))
+    asyncio.set_event_loop_policy(None)
+    return ASYNCIO
+
+async def probe(callbacks: int = 20000, round_trips: int = 1000) -> dict:
+    "Measure callback throughput and socket round trip latency of the running loop"
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+    count = [0]
+    def tick():
+        count[0] += 1
+        if count[0] < callbacks:
+            loop.call_soon(tick)
+        else:
+            done.set_result(None)
+    start = time.perf_counter()
+    loop.call_soon(tick)
+    await done
+    per_callback = (time.perf_counter() - start) / callbacks
+    left, right = socket.socketpair()
+    try:
+        reader, writer = await asyncio.open_connection(sock = left)
+        peer_reader, peer_writer = await asyncio.open_connection(sock = right)
+        start = time.perf_counter()
+        for _ in range(round_trips):
+            writer.write(b"x")
+            peer_writer.write(await peer_reader.readexactly(1))
+            await reader.readexactly(1)
+        round_trip = (time.perf_counter() - start) / round_trips
+        writer.close()
+        peer_writer.close()
+    finally:
+        left.close()
+        right.close()
+    return {"callbacks_per_second": 1 / per_callback, "round_trip_us": round_trip * 1e6}
+
+def benchmark():
+    "Compare the asyncio and uvloop event loops"
+    for kind in (ASYNCIO, UVLOOP):
+        if kind == UVLOOP and uvloop is None:
+            print("uvloop".rjust(8), "not installed")
+            continue
+        use_loop(kind)
+        result = asyncio.run(probe(200000, 20000))
+        print(
+            kind.rjust(8),
+            ("%.0f" % result["callbacks_per_second"]).rjust(10), "callbacks/s",
+            ("%.1f us" % result["round_trip_us"]).rjust(10), "round trip"
+        )
+    use_loop(ASYNCIO)
+
 class ServerBase():
-    """ Server Interface that provides start method """
+    """ Server Interface that provides start method
+
+    Socket buffer sizes of 0 keep the system defaults. They are set on the
+    listening socket, which accepted connections inherit. protocol is
+    what the web server speaks on it, SCGI or FASTCGI.
+    """
+    send_buffer = 0
+    receive_buffer = 0
+    protocol = SCGI
     def __str__(self):
-        return repr(self)[1:-3]
-    def start(self, client_connected_cb, **kwargs):
+        return repr(self)[1:-3] + (' protocol="' + self.protocol + '"' if self.protocol != SCGI else "")
+    def tune(self, sock: socket.socket):
+        "Apply the socket options before listen"
+        if self.send_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        if self.receive_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+    def bind(self, reuse_port: bool = False, backlog: int = 100) -> socket.socket:
+        "Create the listening socket ahead of start - Must be implemented"
+        raise NotImplementedError()
+    def start(self, client_connected_cb, sock: socket.socket = None, **kwargs):
         "Start server and return coroutine - Must be implemented"
         raise NotImplementedError()
 
@@ -18,15 +113,33 @@ class UnixServer(ServerBase):
         self.path = path
     def __repr__(self) -> str:
         return '<UnixServer path="'+self.path+'" />'
-    def start(self, client_connected_cb, **kwargs):
+    def bind(self, reuse_port: bool = False, backlog: int = 100) -> socket.socket:
+        "Create the listening socket ahead of start"
+        try:
+            if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                ## Stale socket left behind by a previous run
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.tune(sock)
+        sock.bind(self.path)
+        sock.listen(backlog)
+        sock.setblocking(False)
+        return sock
+    def start(self, client_connected_cb, sock: socket.socket = None, **kwargs):
         "Start server and return coroutine"
-        return asyncio.start_unix_server(client_connected_cb, self.path, **kwargs)
+        if sock is None:
+            sock = self.bind(backlog = kwargs.pop("backlog", 100))
+        kwargs.setdefault("limit", STREAM_LIMIT)
+        return asyncio.start_unix_server(client_connected_cb, sock=sock, **kwargs)
 
 class NetServer(ServerBase):
-    "Net Server"
-    def __init__(self, host: str, port: int):
+    "Net Server - nodelay sends small responses without waiting for ACKs"
+    def __init__(self, host: str, port: int, nodelay: bool = True):
         self.host = host
         self.port = port
+        self.nodelay = nodelay
     def __repr__(self) -> str:
         return '"'.join((
             '<NetServer host=',
@@ -35,6 +148,33 @@ class NetServer(ServerBase):
             str(self.port),
             ' />'
         ))
-    def start(self, client_connected_cb, **kwargs):
+    def bind(self, reuse_port: bool = False, backlog: int = 100) -> socket.socket:
+        """ Create the listening socket ahead of start
+
+        One socket is shared by the workers, so only the first address the
+        host resolves to is bound - a dual stack name like localhost gets
+        one family. Name the address to listen on in config.ini, an empty
+        host is the wildcard address.
+        """
+        addresses = socket.getaddrinfo(
+            self.host or None, self.port & 65535, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE
+        )
+        family, socktype, proto, _, addr = addresses[0]
+        if len(addresses) > 1:
+            log.warning("Listening on", addr[0], "only, not", ", ".join(item[4][0] for item in addresses[1:]))
+        sock = socket.socket(family, socktype, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.nodelay))
+        self.tune(sock)
+        sock.bind(addr)
+        sock.listen(backlog)
+        sock.setblocking(False)
+        return sock
+    def start(self, client_connected_cb, sock: socket.socket = None, **kwargs):
         "Start server and return coroutine"
-        return asyncio.start_server(client_connected_cb, self.host, self.port & 65535, **kwargs)
+        if sock is None:
+            sock = self.bind(backlog = kwargs.pop("backlog", 100))
+        kwargs.setdefault("limit", STREAM_LIMIT)
+        return asyncio.start_server(client_connected_cb, sock=sock, **kwargs)
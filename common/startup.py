@@ -0,0 +1,96 @@
+#! /usr/bin/python3
+
+import os
+import time
+
+from . import log
+
+__doc__ = "Startup profile - Import times and the time until the first accept"
+
+## Set by server.py when it restarts itself under -X importtime
+ENV = "SCGI_STARTUP_PROFILE"
+## Milliseconds allowed from process start to accepting, 0 for no budget
+BUDGET = 0
+## Slowest imports listed in the report
+TOP = 15
+
+class Profile():
+    """ Timestamps of the startup phases, relative to the process start
+
+    path holds the -X importtime output, stderr the descriptor of the real
+    standard error to restore once the report is made.
+    """
+    def __init__(self, started: float, path: str = None, stderr: int = None):
+        self.started = started
+        self.path = path
+        self.stderr = stderr
+        self.marks = []
+    def __repr__(self) -> str:
+        return "<Profile marks=" + str(len(self.marks)) + " />"
+    @classmethod
+    def from_env(cls, started: float):
+        "Profile handed over by the restart, or a new one without import times"
+        value = os.environ.pop(ENV, None)
+        if not value:
+            return cls(started)
+        path, stderr, started = value.rsplit(",", 2)
+        return cls(float(started), path, int(stderr))
+    def mark(self, name: str):
+        "Record the end of a startup phase"
+        self.marks.append((name, time.monotonic() - self.started))
+    def elapsed(self) -> float:
+        "Seconds since the process started"
+        return time.monotonic() - self.started
+    def imports(self) -> list:
+        "(self, cumulative, name) in microseconds of every import so far"
+        if self.path is None:
+            return []
+        result = []
+        with open(self.path, encoding = "utf-8", errors = "replace") as fin:
+            for line in fin:
+                if not line.startswith("import time:") or "|" not in line:
+                    continue
+                own, total, name = line[12:].split("|", 2)
+                try:
+                    result.append((int(own), int(total), name.rstrip()))
+                except ValueError:
+                    ## The column titles
+                    continue
+        return result
+    def finish(self):
+        "Give standard error back and drop the import log"
+        if self.stderr is not None:
+            os.dup2(self.stderr, 2)
+            os.close(self.stderr)
+            self.stderr = None
+        if self.path is not None:
+            os.unlink(self.path)
+            self.path = None
+    def report(self) -> bool:
+        "Log the profile, return whether startup stayed within BUDGET"
+        total = self.marks[-1][1] if self.marks else self.elapsed()
+        imports = self.imports()
+        self.finish()
+        lines = ["Startup profile"]
+        previous = 0
+        for name, at in self.marks:
+            lines.append("  " + name.ljust(24) + ("%8.1f ms" % (at * 1000)) + ("  +%.1f" % ((at - previous) * 1000)))
+            previous = at
+        if imports:
+            ## Top level imports have no indent in their name
+            spent = sum(item[1] for item in imports if not item[2].startswith("  "))
+            lines.append("  imports " + str(len(imports)) + " modules, %.1f ms" % (spent / 1000))
+            for own, cumulative, name in sorted(imports, reverse = True)[:TOP]:
+                lines.append(
+                    "    " + name.strip().ljust(36) + ("%8.1f ms" % (own / 1000))
+                    + ("%8.1f ms cumulative" % (cumulative / 1000))
+                )
+        else:
+            lines.append("  import times need the restart under -X importtime")
+        within = not BUDGET or total * 1000 <= BUDGET
+        lines.append(
+            "  accepting after %.1f ms" % (total * 1000)
+            + ("" if not BUDGET else ", budget %d ms %s" % (BUDGET, "met" if within else "EXCEEDED"))
+        )
+        log.LOG.log(log.INFO if within else log.ERROR, "\n".join(lines))
+        return within
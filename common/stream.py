@@ -0,0 +1,68 @@
+#! /usr/bin/python3
+
+import asyncio
+
+from . import error
+
+__doc__ = "Streaming access to the request body"
+
+## Size of chunks handed out by BodyReader
+CHUNK_SIZE = 1 << 16
+## Seconds a single read may wait for the client before giving up
+TIMEOUT = 60
+
+def deadline(stdin: asyncio.streams.StreamReader, timeout: float) -> asyncio.TimerHandle:
+    """ Fail reads of stdin with TimeoutError after timeout seconds
+
+    Cheaper than asyncio.wait_for as no task is created. Cancel the returned
+    handle once the reads are done.
+    """
+    return asyncio.get_running_loop().call_later(timeout, stdin.set_exception, TimeoutError())
+
+class BodyReader():
+    """ Read the request body without going past CONTENT_LENGTH
+
+    Iterate with async for to get chunks of at most chunk_size bytes, so
+    only one chunk plus the StreamReader buffer is held at any time.
+    """
+    def __init__(self, stdin: asyncio.streams.StreamReader, length: int, chunk_size: int = None):
+        self.stdin = stdin
+        ## A negative length would turn reads into read(-1), up to EOF
+        self.remaining = max(length, 0)
+        self.chunk_size = chunk_size or CHUNK_SIZE
+    def __repr__(self) -> str:
+        return "<BodyReader remaining=" + str(self.remaining) + " />"
+    def __aiter__(self):
+        return self
+    async def __anext__(self) -> bytes:
+        chunk = await self.read(self.chunk_size)
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+    async def read(self, size: int = -1) -> bytes:
+        "Read up to size bytes, or the whole remaining body when size < 0"
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return b""
+        timer = deadline(self.stdin, TIMEOUT)
+        try:
+            if size == self.remaining and size > self.chunk_size:
+                ## Whole body requested
+                data = await self.stdin.readexactly(size)
+            else:
+                data = await self.stdin.read(size)
+        except asyncio.IncompleteReadError as err:
+            raise error.ResponseError(400, "Incomplete body") from err
+        except TimeoutError as err:
+            raise error.ResponseError(408) from err
+        finally:
+            timer.cancel()
+        if not data:
+            raise error.ResponseError(400, "Incomplete body")
+        self.remaining -= len(data)
+        return data
+    async def discard(self):
+        "Consume what is left of the body"
+        while await self.read(self.chunk_size):
+            pass
@@ -0,0 +1,97 @@
+#! /usr/bin/python3
+
+import asyncio
+import time
+
+from . import log
+
+__doc__ = "System metrics read from /proc without spawning processes"
+
+## Seconds between two samples of the background sampler
+INTERVAL = 5
+
+def read_loadavg(path: str = "/proc/loadavg") -> dict:
+    "Load averages and task counts"
+    with open(path, "r", encoding="ascii") as fin:
+        fields = fin.read().split()
+    running, total = fields[3].split("/", 1)
+    return {
+        "loadavg": [float(item) for item in fields[:3]],
+        "running": int(running),
+        "tasks": int(total)
+    }
+
+def read_uptime(path: str = "/proc/uptime") -> float:
+    "Seconds since boot"
+    with open(path, "r", encoding="ascii") as fin:
+        return float(fin.read().split()[0])
+
+def read_meminfo(path: str = "/proc/meminfo") -> dict:
+    "Memory statistics in bytes, keyed as in /proc/meminfo"
+    result = {}
+    with open(path, "r", encoding="ascii") as fin:
+        for line in fin:
+            name, _, value = line.partition(":")
+            value = value.split()
+            if value:
+                result[name] = int(value[0]) << 10 if value[1:] == ["kB"] else int(value[0])
+    return result
+
+def memory_summary(meminfo: dict) -> dict:
+    "Reduce meminfo into the columns shown by free"
+    cache = meminfo.get("Cached", 0) + meminfo.get("SReclaimable", 0)
+    buffers = meminfo.get("Buffers", 0)
+    total = meminfo.get("MemTotal", 0)
+    free = meminfo.get("MemFree", 0)
+    used = total - free - buffers - cache
+    return {
+        "total": total,
+        "used": used if used >= 0 else total - free,
+        "free": free,
+        "shared": meminfo.get("Shmem", 0),
+        "buff_cache": buffers + cache,
+        "available": meminfo.get("MemAvailable", free),
+        "swap_total": meminfo.get("SwapTotal", 0),
+        "swap_used": meminfo.get("SwapTotal", 0) - meminfo.get("SwapFree", 0),
+        "swap_free": meminfo.get("SwapFree", 0)
+    }
+
+def sample() -> dict:
+    "Take one snapshot of the system metrics"
+    result = read_loadavg()
+    result["time"] = time.time()
+    result["uptime"] = read_uptime()
+    result["memory"] = memory_summary(read_meminfo())
+    return result
+
+class Sampler():
+    """ Keep the latest metrics snapshot, refreshed by a background task
+
+    The task is started on first use from within the running event loop,
+    so readers only ever touch the cached snapshot.
+    """
+    def __init__(self, interval: float = None):
+        self.interval = interval
+        self.snapshot = None
+        self._task = None
+    def __repr__(self) -> str:
+        return "<Sampler interval=" + str(self.interval or INTERVAL) + " />"
+    def get(self) -> dict:
+        "Return the latest snapshot, starting the sampler if needed"
+        if self._task is None or self._task.done():
+            if self.snapshot is None:
+                self.snapshot = sample()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return self.snapshot
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval or INTERVAL)
+            try:
+                self.snapshot = sample()
+            except OSError as err:
+                log.warning("Failed to sample system metrics:", repr(err))
+    def stop(self):
+        "Cancel the background task"
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
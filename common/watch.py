@@ -0,0 +1,151 @@
+#! /usr/bin/python3
+
+import asyncio
+import os
+import struct
+
+from . import lazy
+from . import log
+
+ctypes = lazy.module("ctypes")
+
+__doc__ = "Watch files for changes with inotify, or by polling their mtime"
+
+INOTIFY, POLL = "inotify", "poll"
+## Seconds between checks when polling
+POLL_INTERVAL = 1.0
+## Seconds to wait for further changes before reporting, editors write in steps
+SETTLE = 0.2
+
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+## Close after write, rename into place, creation and attribute change (touch)
+_IN_MASK = 0x8 | 0x80 | 0x100 | 0x4
+## wd, mask, cookie and length of the name following the event
+_EVENT = struct.Struct("iIII")
+
+def _inotify():
+    "libc with the inotify calls, None when unavailable"
+    import ctypes.util #pylint: disable=import-outside-toplevel,redefined-outer-name
+    name = ctypes.util.find_library("c")
+    try:
+        libc = ctypes.CDLL(name, use_errno = True)
+        libc.inotify_init1.argtypes = (ctypes.c_int,)
+        libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+def mtime(path: str) -> int:
+    "Modification time of path in ns, None when missing"
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+class Watcher():
+    """ Call callback(paths) on the loop when watched files change
+
+    The directories holding the files are watched with inotify where
+    available, otherwise the files are polled every POLL_INTERVAL seconds.
+    A file is reported when its mtime changed since the last report, and
+    changes within SETTLE seconds of each other are reported together.
+    """
+    def __init__(self, callback, method: str = None):
+        self.callback = callback
+        self.method = method
+        self.mtimes = {}
+        self._libc = None
+        self._fd = None
+        self._dirs = {}
+        self._loop = None
+        self._timer = None
+        self._settle = None
+    def __repr__(self) -> str:
+        return "<Watcher method=" + str(self.method) + " files=" + str(len(self.mtimes)) + " />"
+
+    def start(self, paths=()):
+        "Start watching from within the running loop"
+        self._loop = asyncio.get_running_loop()
+        if self.method in (None, INOTIFY):
+            self._libc = _inotify()
+            fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC) if self._libc is not None else -1
+            if fd >= 0:
+                self._fd = fd
+                self.method = INOTIFY
+                self._loop.add_reader(fd, self._read)
+            elif self.method == INOTIFY:
+                raise OSError(ctypes.get_errno(), "inotify unavailable")
+            else:
+                self.method = POLL
+        if self.method == POLL:
+            self._timer = self._loop.call_later(POLL_INTERVAL, self._poll)
+        self.watch(paths)
+
+    def stop(self):
+        "Stop watching and release the inotify descriptor"
+        for item in (self._timer, self._settle):
+            if item is not None:
+                item.cancel()
+        self._timer = self._settle = None
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+            self._dirs.clear()
+
+    def watch(self, paths):
+        "Replace the set of watched files, their current state is the baseline"
+        self.mtimes = {os.path.abspath(item): mtime(item) for item in paths}
+        if self._fd is None:
+            return
+        wanted = {os.path.dirname(item) for item in self.mtimes}
+        for wd, path in list(self._dirs.items()):
+            if path not in wanted:
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._dirs[wd]
+        for path in wanted.difference(self._dirs.values()):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), _IN_MASK)
+            if wd < 0:
+                log.warning("Cannot watch", path, os.strerror(ctypes.get_errno()))
+            else:
+                self._dirs[wd] = path
+
+    def _read(self):
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+        pos = 0
+        hit = False
+        while pos < len(data):
+            wd, _, _, size = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = data[pos:pos + size].rstrip(b"\0")
+            pos += size
+            if wd in self._dirs and os.path.join(self._dirs[wd], os.fsdecode(name)) in self.mtimes:
+                hit = True
+        if hit:
+            if self._settle is not None:
+                self._settle.cancel()
+            self._settle = self._loop.call_later(SETTLE, self._check)
+
+    def _poll(self):
+        self._timer = self._loop.call_later(POLL_INTERVAL, self._poll)
+        self._check()
+
+    def _check(self):
+        self._settle = None
+        changed = []
+        for path, known in self.mtimes.items():
+            current = mtime(path)
+            ## A file being replaced may be missing for a moment
+            if current is not None and current != known:
+                self.mtimes[path] = current
+                changed.append(path)
+        if changed:
+            try:
+                self.callback(changed)
+            except Exception: #pylint: disable=broad-except
+                log.exception("Watcher callback failed")
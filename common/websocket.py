@@ -0,0 +1,657 @@
+#! /usr/bin/python3
+
+import asyncio
+import base64
+import hashlib
+import os
+import struct
+import time
+import zlib
+
+from . import compress
+from . import lazy
+from . import log
+from . import offload
+from . import output
+from . import stream
+
+numpy = lazy.module("numpy")
+
+__doc__ = "WebSocket framing and full-duplex sessions"
+
+## Constants for OPCODE
+OPCODE_CONTINUE = 0
+OPCODE_TEXT = 1
+OPCODE_BINARY = 2
+OPCODE_CLOSE = 8
+OPCODE_PING = 9
+OPCODE_PONG = 10
+
+## Close codes
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+CLOSE_INTERNAL_ERROR = 1011
+
+## Bytes XORed per big integer operation, a multiple of 4 to keep the mask phase
+MASK_CHUNK = 1 << 16
+## Below this size the integer path beats the numpy call overhead
+NUMPY_THRESHOLD = 1 << 10
+
+## Session defaults, set from the [WebSocket] section of config.ini
+## Outbound messages are split in frames of at most this size
+FRAGMENT_SIZE = 1 << 16
+## Frames buffered per direction before the producer has to wait
+QUEUE_SIZE = 16
+## Seconds between pings, 0 disables them
+PING_INTERVAL = 30
+## Seconds to wait for the pong before dropping the client
+PING_TIMEOUT = 10
+## Largest message accepted from the client
+MAX_MESSAGE = 1 << 24
+## Seconds to wait for the close reply of the client
+CLOSE_TIMEOUT = 5
+
+## permessage-deflate - Accept offers from clients
+DEFLATE = True
+DEFLATE_LEVEL = 6
+## Messages below this size are sent uncompressed
+DEFLATE_MIN_SIZE = 512
+## LZ77 window of our compressor, 9 to 15 - Smaller saves memory per socket
+DEFLATE_WINDOW_BITS = 15
+## Window asked of clients offering client_max_window_bits
+DEFLATE_CLIENT_BITS = 15
+## Keep the compressor state between messages
+DEFLATE_TAKEOVER = True
+## Flush marker dropped from the end of every compressed message
+DEFLATE_TAIL = b"\x00\x00\xff\xff"
+
+def accept_key(value: str) -> str:
+    """ Calculate the Websocket Accept header """
+    hasher = hashlib.sha1()
+    hasher.update(value.encode("ascii"))
+    hasher.update(b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11")
+    return base64.b64encode(hasher.digest()).decode("ascii")
+
+def mask_payload(data, mask: bytes):
+    """ XOR data in place with the 4 byte mask
+
+    data must be a writable buffer such as bytearray. Works word-at-a-time
+    with numpy when available, otherwise on big integers in MASK_CHUNK
+    slices, and never builds a repeated copy of the mask.
+    """
+    view = memoryview(data).cast("B")
+    size = len(view)
+    if not size:
+        return data
+    if numpy is not None and size >= NUMPY_THRESHOLD:
+        words = size >> 2
+        numpy.frombuffer(view[:words << 2], dtype=numpy.uint32)[...] ^= \
+            numpy.frombuffer(mask, dtype=numpy.uint32)[0]
+        for item in range(words << 2, size):
+            view[item] ^= mask[item & 3]
+        return data
+    chunk = min(MASK_CHUNK, (size + 3) & ~3)
+    ## The mask repeated over a whole chunk, as one integer
+    pattern = int.from_bytes(mask, "little") * (((1 << (chunk << 3)) - 1) // 0xFFFFFFFF)
+    for start in range(0, size, chunk):
+        segment = view[start:start + chunk]
+        length = len(segment)
+        segment[:] = (int.from_bytes(segment, "little") ^ (
+            pattern if length == chunk else pattern & ((1 << (length << 3)) - 1)
+        )).to_bytes(length, "little")
+    return data
+
+def _mask_loop(data: bytearray, mask: bytes):
+    "Previous per-byte masking, kept for benchmarking"
+    for item in range(len(data)):
+        data[item] ^= mask[item & 3]
+    return data
+
+def frame_header(opcode: int, length: int, fin: bool = True, rsv: int = 0, mask: bytes = None) -> bytes:
+    "Header of a frame carrying length bytes"
+    first = (fin << 7) | (rsv << 4) | opcode
+    masked = 0x80 if mask else 0
+    if length < 126:
+        head = struct.pack("!BB", first, masked | length)
+    elif length < (1 << 16):
+        head = struct.pack("!BBH", first, masked | 126, length)
+    else:
+        head = struct.pack("!BBQ", first, masked | 127, length)
+    return head + mask if mask else head
+
+def encode_frame(opcode: int, data=b"", fin: bool = True, rsv: int = 0, masked: bool = False) -> list:
+    "One frame as a list of buffers for writelines"
+    mask = os.urandom(4) if masked else None
+    if mask and data:
+        data = mask_payload(bytearray(data), mask)
+    head = frame_header(opcode, len(data), fin, rsv, mask)
+    return [head, data] if data else [head]
+
+async def read_frame_header(stdin: asyncio.streams.StreamReader) -> tuple:
+    "Read a frame header, returning (fin, rsv, opcode, length, mask)"
+    head = await stdin.readexactly(2)
+    length = head[1] & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", await stdin.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await stdin.readexactly(8))[0]
+    mask = await stdin.readexactly(4) if head[1] & 0x80 else None
+    return bool(head[0] & 0x80), (head[0] >> 4) & 7, head[0] & 0x0F, length, mask
+
+def upgrade(header, stdout, extensions: str = None) -> bool:
+    """ Answer the handshake with 101, or 400 when it is not a WebSocket request """
+    if (header.get("HTTP_UPGRADE") or "").lower() != "websocket" or not header.get("HTTP_SEC_WEBSOCKET_KEY"):
+        output.write_response(header, stdout, output.Response(400, body = "Bad request"))
+        return False
+    resp = output.Response(101, {
+        "Upgrade": "websocket",
+        "Connection": "Upgrade",
+        "Sec-Websocket-Accept": accept_key(header["HTTP_SEC_WEBSOCKET_KEY"])
+    })
+    if extensions:
+        resp.add_header("Sec-WebSocket-Extensions", extensions)
+    output.write_response(header, stdout, resp)
+    return True
+
+def accept(header, stdin, stdout, **kwargs):
+    """ Complete the handshake and return a Session, None after answering 400
+
+    permessage-deflate is negotiated from HTTP_SEC_WEBSOCKET_EXTENSIONS
+    when DEFLATE is set. kwargs go to Session.
+    """
+    deflate = PerMessageDeflate.negotiate(header.get("HTTP_SEC_WEBSOCKET_EXTENSIONS")) if DEFLATE else None
+    if not upgrade(header, stdout, deflate and deflate.response()):
+        return None
+    return Session(stdin, stdout, deflate = deflate, **kwargs)
+
+class PerMessageDeflate():
+    """ RFC 7692 permessage-deflate parameters and zlib state of a connection
+
+    server_bits and client_bits are the LZ77 window sizes, the takeover
+    flags whether each side keeps its compression context between messages.
+    """
+    def __init__(
+        self,
+        server_bits: int = 15,
+        client_bits: int = None,
+        server_takeover: bool = True,
+        client_takeover: bool = True,
+        level: int = None,
+        min_size: int = None
+    ):
+        self.server_bits = server_bits
+        ## None when the client did not offer client_max_window_bits
+        self.client_bits = client_bits
+        self.server_takeover = server_takeover
+        self.client_takeover = client_takeover
+        self.level = DEFLATE_LEVEL if level is None else level
+        self.min_size = DEFLATE_MIN_SIZE if min_size is None else min_size
+        self._compressor = None
+        self._decompressor = None
+    def __repr__(self) -> str:
+        return "<PerMessageDeflate " + self.response() + " />"
+
+    @classmethod
+    def negotiate(cls, offers: str):
+        "Accept the first acceptable permessage-deflate offer, None if there is none"
+        for offer in (offers or "").split(","):
+            name, *params = [item.strip() for item in offer.split(";")]
+            if name.lower() != "permessage-deflate":
+                continue
+            try:
+                return cls.from_offer(params)
+            except ValueError as err:
+                log.debug("Declined permessage-deflate offer", repr(err))
+        return None
+    @classmethod
+    def from_offer(cls, params: list):
+        "Parameters agreed for one offer, ValueError when it cannot be accepted"
+        offer = {}
+        for item in params:
+            key, sep, value = item.partition("=")
+            key = key.strip().lower()
+            if key in offer:
+                raise ValueError("Duplicate parameter " + key)
+            offer[key] = value.strip().strip('"') if sep else None
+        result = cls(
+            server_bits = DEFLATE_WINDOW_BITS,
+            server_takeover = DEFLATE_TAKEOVER
+        )
+        for key, value in offer.items():
+            if key == "server_no_context_takeover" and value is None:
+                result.server_takeover = False
+            elif key == "client_no_context_takeover" and value is None:
+                result.client_takeover = False
+            elif key == "server_max_window_bits" and value is not None:
+                if not value.isdigit() or not 8 <= int(value) <= 15:
+                    raise ValueError("Bad server_max_window_bits " + value)
+                if int(value) == 8:
+                    ## zlib cannot produce raw deflate with a 256 byte window
+                    raise ValueError("Unsupported server_max_window_bits 8")
+                result.server_bits = min(int(value), DEFLATE_WINDOW_BITS)
+            elif key == "client_max_window_bits":
+                if value is not None and (not value.isdigit() or not 8 <= int(value) <= 15):
+                    raise ValueError("Bad client_max_window_bits " + value)
+                result.client_bits = min(int(value or 15), DEFLATE_CLIENT_BITS)
+            else:
+                raise ValueError("Unknown parameter " + key)
+        return result
+    def response(self) -> str:
+        "Sec-WebSocket-Extensions value accepting the offer"
+        result = ["permessage-deflate"]
+        if not self.server_takeover:
+            result.append("server_no_context_takeover")
+        if not self.client_takeover:
+            result.append("client_no_context_takeover")
+        if self.server_bits < 15:
+            result.append("server_max_window_bits=" + str(self.server_bits))
+        if self.client_bits is not None and self.client_bits < 15:
+            result.append("client_max_window_bits=" + str(self.client_bits))
+        return "; ".join(result)
+
+    def compress(self, data, fin: bool) -> bytes:
+        "Compress the next part of an outbound message"
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.server_bits)
+        result = self._compressor.compress(data)
+        if not fin:
+            return result
+        result += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if not self.server_takeover:
+            self._compressor = None
+        return result[:-4] if result.endswith(DEFLATE_TAIL) else result
+    def decompress(self, data, fin: bool):
+        "Inflate the next part of an inbound message, yielding pieces of at most CHUNK_SIZE"
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        engine = self._decompressor
+        for item in (data, DEFLATE_TAIL if fin else b""):
+            while item:
+                piece = engine.decompress(item, stream.CHUNK_SIZE)
+                item = engine.unconsumed_tail
+                if piece:
+                    yield piece
+        if fin and not self.client_takeover:
+            self._decompressor = None
+
+class ProtocolError(Exception):
+    " The client broke the framing rules, carries the close code "
+    def __init__(self, code: int, reason: str = ""):
+        super().__init__(code, reason)
+        self.code = code
+        self.reason = reason
+
+class Session():
+    """ Full-duplex WebSocket connection after the upgrade
+
+    A reader task parses frames and a writer task sends them, each through
+    a queue of queue_size frames, so a slow consumer or a slow client
+    pushes back on the other side instead of growing buffers. With deflate
+    the messages are compressed and inflated transparently. Iterate with
+    async for to get (opcode, chunk, final) as the payload arrives - the
+    opcode is OPCODE_CONTINUE after the first chunk of a message - or await
+    recv() for whole messages. Control frames are answered by the reader
+    and pings are sent every ping_interval seconds.
+
+        async with Session(stdin, stdout) as session:
+            async for opcode, chunk, final in session:
+                await session.send_frame(opcode, chunk, final)
+    """
+    def __init__(
+        self,
+        stdin: asyncio.streams.StreamReader,
+        stdout: asyncio.streams.StreamWriter,
+        fragment_size: int = None,
+        queue_size: int = None,
+        ping_interval: float = None,
+        ping_timeout: float = None,
+        max_message: int = None,
+        deflate: PerMessageDeflate = None
+    ):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.fragment_size = fragment_size or FRAGMENT_SIZE
+        self.ping_interval = PING_INTERVAL if ping_interval is None else ping_interval
+        self.ping_timeout = ping_timeout or PING_TIMEOUT
+        self.max_message = max_message or MAX_MESSAGE
+        self.deflate = deflate
+        self.inbound = asyncio.Queue(queue_size or QUEUE_SIZE)
+        self.outbound = asyncio.Queue(queue_size or QUEUE_SIZE)
+        self.close_code = None
+        self.latency = None
+        self._close_sent = False
+        self._closed = asyncio.Event()
+        self._sending = asyncio.Lock()
+        self._tasks = ()
+        self._timer = None
+        self._ended = False
+        ## Whether the outbound message being sent is compressed
+        self._compressing = False
+        ## Whether a message is half sent, so no other may go in between
+        self._streaming = False
+    def __repr__(self) -> str:
+        return "".join((
+            "<WebSocketSession inbound=", str(self.inbound.qsize()),
+            " outbound=", str(self.outbound.qsize()),
+            " closed=", str(self.closed).lower(), " />"
+        ))
+    @property
+    def closed(self) -> bool:
+        "Whether the connection is done"
+        return self._closed.is_set()
+
+    def start(self):
+        "Spawn the reader and writer and schedule the first ping"
+        loop = asyncio.get_running_loop()
+        self._tasks = (loop.create_task(self._read_loop()), loop.create_task(self._write_loop()))
+        if self.ping_interval:
+            self._timer = loop.call_later(self.ping_interval, self._ping)
+    async def __aenter__(self):
+        self.start()
+        return self
+    async def __aexit__(self, *_):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+    async def __anext__(self) -> tuple:
+        item = await self.inbound.get()
+        if item is None:
+            ## Keep the end mark for other readers
+            self.inbound.put_nowait(None)
+            raise StopAsyncIteration
+        return item
+    async def recv(self) -> tuple:
+        "Next whole message as (opcode, bytes), None once closed"
+        opcode, chunks = None, []
+        async for item in self:
+            if opcode is None:
+                opcode = item[0]
+            chunks.append(item[1])
+            if item[2]:
+                return opcode, b"".join(chunks)
+        return None
+
+    async def send_frame(self, opcode: int, data=b"", fin: bool = True):
+        """ Queue one frame, waiting while the queue is full
+
+        For a message streamed over several calls, pass the opcode first
+        and OPCODE_CONTINUE afterwards. Frames above fragment_size are split.
+        """
+        if self._close_sent or self.closed:
+            raise ConnectionResetError("WebSocket closed")
+        rsv = 0
+        if self.deflate is not None:
+            if opcode != OPCODE_CONTINUE:
+                ## Small messages are not worth compressing
+                self._compressing = not fin or len(data) >= self.deflate.min_size
+                rsv = 4 if self._compressing else 0
+            if self._compressing:
+                if len(data) > compress.THREAD_SIZE:
+                    data = await offload.run(offload.THREAD, self.deflate.compress, data, fin)
+                else:
+                    data = self.deflate.compress(data, fin)
+        view = memoryview(data).cast("B")
+        if not fin or len(view) > self.fragment_size:
+            ## Kept until the last frame is queued, offer waits for it
+            self._streaming = True
+        while len(view) > self.fragment_size:
+            await self.outbound.put(encode_frame(opcode, view[:self.fragment_size], False, rsv))
+            view = view[self.fragment_size:]
+            opcode, rsv = OPCODE_CONTINUE, 0
+        await self.outbound.put(encode_frame(opcode, view, fin, rsv))
+        self._streaming = not fin
+    async def send(self, data, binary: bool = None):
+        "Send a whole message, str as text and anything else as binary"
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+            binary = False if binary is None else binary
+        opcode = OPCODE_BINARY if binary or binary is None else OPCODE_TEXT
+        async with self._sending:
+            await self.send_frame(opcode, data)
+
+    def offer(self, frame) -> bool:
+        """ Queue a ready made whole message frame without waiting
+
+        Returns False when the queue is full, a fragmented message is being
+        sent or the session is closing.
+        """
+        if self._close_sent or self.closed or self._streaming or self.outbound.full():
+            return False
+        self.outbound.put_nowait(frame)
+        return True
+    def abort(self, code: int = CLOSE_INTERNAL_ERROR, reason: str = ""):
+        "Send close right away, skipping queued frames, and stop"
+        if not self._close_sent:
+            self._close_sent = True
+            self._write(encode_frame(OPCODE_CLOSE, struct.pack("!H", code) + reason.encode("utf-8")))
+        self.close_code = code
+        self._shutdown()
+
+    async def close(self, code: int = CLOSE_NORMAL, reason: str = ""):
+        "Send close after the queued frames and wait for the client to answer"
+        if not self.closed:
+            if not self._close_sent:
+                self._close_sent = True
+                await self.outbound.put(encode_frame(
+                    OPCODE_CLOSE, struct.pack("!H", code) + reason.encode("utf-8")
+                ))
+            try:
+                await asyncio.wait_for(self._closed.wait(), CLOSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                log.debug("WebSocket close not answered")
+        self._shutdown()
+        await asyncio.gather(*self._tasks, return_exceptions = True)
+
+    def _write(self, frame: list):
+        "Write a control frame now, between the queued data frames"
+        try:
+            self.stdout.writelines(frame)
+        except (ConnectionError, RuntimeError):
+            self._shutdown()
+    def _shutdown(self):
+        "Stop every task and timer without further handshake"
+        self._closed.set()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for item in self._tasks:
+            if item is not asyncio.current_task():
+                item.cancel()
+        if self._ended:
+            return
+        self._ended = True
+        ## Wake senders waiting for room, and anyone iterating
+        while not self.outbound.empty():
+            self.outbound.get_nowait()
+        if self.inbound.full():
+            self.inbound.get_nowait()
+        self.inbound.put_nowait(None)
+
+    def _ping(self):
+        if self.closed:
+            return
+        self._write(encode_frame(OPCODE_PING, struct.pack("!d", time.monotonic())))
+        self._timer = asyncio.get_running_loop().call_later(self.ping_timeout, self._ping_timeout)
+    def _ping_timeout(self):
+        log.debug("WebSocket ping timed out")
+        self.close_code = CLOSE_INTERNAL_ERROR
+        self._shutdown()
+    def _pong(self, data: bytes):
+        if len(data) == 8 and self._timer is not None and self.ping_interval:
+            self.latency = time.monotonic() - struct.unpack("!d", data)[0]
+            self._timer.cancel()
+            self._timer = asyncio.get_running_loop().call_later(self.ping_interval, self._ping)
+
+    async def _write_loop(self):
+        try:
+            while True:
+                frame = await self.outbound.get()
+                self.stdout.writelines(frame)
+                await self.stdout.drain()
+        except ConnectionError:
+            log.debug("WebSocket connection lost while writing")
+            self._shutdown()
+
+    async def _read_loop(self):
+        try:
+            await self._read_frames()
+        except ProtocolError as err:
+            log.debug("WebSocket protocol error", err.code, err.reason)
+            if not self._close_sent:
+                self._close_sent = True
+                self._write(encode_frame(OPCODE_CLOSE, struct.pack("!H", err.code) + err.reason.encode("utf-8")))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            log.debug("WebSocket connection closed")
+        self._shutdown()
+
+    async def _read_frames(self):
+        message = None
+        size = 0
+        inflate = False
+        pending = None
+        while True:
+            fin, rsv, opcode, length, mask = await read_frame_header(self.stdin)
+            ## RSV1 marks the first frame of a compressed message
+            if rsv & (3 if self.deflate is not None and opcode in (OPCODE_TEXT, OPCODE_BINARY) else 7):
+                raise ProtocolError(CLOSE_PROTOCOL_ERROR, "Unexpected RSV bits")
+            if opcode >= OPCODE_CLOSE:
+                ## Control frames are never fragmented
+                if length > 125 or not fin:
+                    raise ProtocolError(CLOSE_PROTOCOL_ERROR, "Bad control frame")
+                data = bytearray(await self.stdin.readexactly(length))
+                if mask:
+                    mask_payload(data, mask)
+                if opcode == OPCODE_PING:
+                    self._write(encode_frame(OPCODE_PONG, data))
+                elif opcode == OPCODE_PONG:
+                    self._pong(bytes(data))
+                elif opcode == OPCODE_CLOSE:
+                    self.close_code = struct.unpack("!H", data[:2])[0] if len(data) >= 2 else 1005
+                    if not self._close_sent:
+                        self._close_sent = True
+                        self._write(encode_frame(OPCODE_CLOSE, data[:2]))
+                    return
+                continue
+            if (opcode == OPCODE_CONTINUE) != (message is not None):
+                raise ProtocolError(CLOSE_PROTOCOL_ERROR, "Unexpected continuation")
+            if message is None:
+                ## message is the opcode of the next chunk handed on, the
+                ## message opcode first and OPCODE_CONTINUE afterwards
+                message, size, inflate = opcode, 0, bool(rsv & 4)
+            if not inflate:
+                size += length
+                if size > self.max_message:
+                    raise ProtocolError(CLOSE_TOO_BIG, "Message too big")
+            ## Payload is handed on in chunks, CHUNK_SIZE keeps the mask phase
+            remaining = length
+            while True:
+                chunk = bytearray(await self.stdin.readexactly(min(remaining, stream.CHUNK_SIZE)))
+                remaining -= len(chunk)
+                if mask:
+                    mask_payload(chunk, mask)
+                final = fin and not remaining
+                if not inflate:
+                    await self.inbound.put((message, chunk, final))
+                    message = OPCODE_CONTINUE
+                else:
+                    ## One piece held back so the last one can carry final
+                    try:
+                        for piece in self.deflate.decompress(chunk, final):
+                            size += len(piece)
+                            if size > self.max_message:
+                                raise ProtocolError(CLOSE_TOO_BIG, "Message too big")
+                            if pending is not None:
+                                await self.inbound.put((message, pending, False))
+                                message = OPCODE_CONTINUE
+                            pending = piece
+                    except zlib.error as err:
+                        raise ProtocolError(CLOSE_PROTOCOL_ERROR, "Bad compressed data") from err
+                    if final:
+                        await self.inbound.put((message, pending or b"", True))
+                        pending = None
+                if not remaining:
+                    break
+            if fin:
+                message = None
+
+class WebSocketData():
+    """ Websocket Message object - Whole message read and written at once """
+    ## Constants for OPCODE
+    OPCODE_CONTINUE = OPCODE_CONTINUE
+    OPCODE_TEXT = OPCODE_TEXT
+    OPCODE_BINARY = OPCODE_BINARY
+    OPCODE_CLOSE = OPCODE_CLOSE
+    OPCODE_PING = OPCODE_PING
+    OPCODE_PONG = OPCODE_PONG
+
+    def __init__(self, rsv: int, opcode: int, data: bytes, masked: bool = False):
+        self.rsv = rsv
+        self.opcode = opcode
+        self.data = data
+        self.masked = masked
+
+    def __bytes__(self):
+        return b"".join(encode_frame(self.opcode, self.data, True, self.rsv, self.masked))
+    def __eq__(self,other):
+        return self.rsv == other.rsv and self.opcode == other.opcode and self.data == other.data
+    def __str__(self):
+        opcode_processes = {
+            1: ("TEXT", lambda x: x.decode("UTF-8")),
+            2: ("BINARY", str),
+            8: ("CLOSE", lambda x: str(x and int.from_bytes(x[:2], "big") or 1005)),
+            9: ("PING", str)
+        }
+        return "".join((
+            "<WebSocket rsv=\"",
+            str(self.rsv),
+            "\" opcode=\"",
+            opcode_processes[self.opcode][0] \
+                if self.opcode in opcode_processes else str(self.opcode),
+            "\" mask=\""+("false","true")[self.masked]+"\">",
+            self.opcode in opcode_processes \
+                and opcode_processes[self.opcode][1](self.data) or str(self.data),
+            "</WebSocket>"
+        ))
+
+    @staticmethod
+    async def read_websocket(stdin):
+        """ Read WebSocket Data """
+        chunks = []
+        fin = False
+        opcode = rsv = mask = None
+        while not fin:
+            try:
+                fin, frame_rsv, frame_opcode, size, mask = await read_frame_header(stdin)
+                data = bytearray(await stdin.readexactly(size))
+            except (ConnectionError, asyncio.IncompleteReadError):
+                log.debug("WebSocket connection closed")
+                return None
+            if opcode is None:
+                rsv, opcode = frame_rsv, frame_opcode
+            if mask:
+                mask_payload(data, mask)
+            chunks.append(data)
+        return WebSocketData(rsv = rsv, opcode = opcode, data = b"".join(chunks), masked = bool(mask))
+
+def benchmark(duration: float = 0.5):
+    "Compare mask_payload against the per-byte loop from 16 B to 16 MiB"
+    mask = os.urandom(4)
+    for shift in range(4, 25, 2):
+        size = 1 << shift
+        data = bytearray(os.urandom(size))
+        timing = []
+        for fun in (_mask_loop, mask_payload):
+            done = 0
+            start = time.perf_counter()
+            while not done or time.perf_counter() - start < duration:
+                fun(data, mask)
+                done += 1
+            timing.append((time.perf_counter() - start) / done)
+        print(
+            str(size).rjust(9), "B",
+            "loop", ("%.3f ms" % (timing[0] * 1000)).rjust(12),
+            "fast", ("%.3f ms" % (timing[1] * 1000)).rjust(12),
+            ("%.1fx" % (timing[0] / timing[1])).rjust(9)
+        )
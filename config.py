@@ -1,6 +1,7 @@
 #! /usr/bin/python3
 
 import configparser
+import os
 import common
 __doc__ = "Configuration file loader for StaphSCGI."
 
@@ -15,22 +16,159 @@ def load(path: str = "config.ini"):
     if config["Server"]["type"] == "net":
         server = common.server.NetServer(
             host = config["Server"]["host"],
-            port = config["Server"].getint("port")
+            port = config["Server"].getint("port"),
+            nodelay = config["Server"].getboolean("tcp nodelay", True)
         )
     elif config["Server"]["type"] == "unix":
         server = common.server.UnixServer( path = config["Server"]["path"] )
     else:
         raise NotImplementedError()
+    server.protocol = config["Server"].get("protocol", common.server.SCGI).strip().lower()
+    if server.protocol not in (common.server.SCGI, common.server.FASTCGI):
+        raise ValueError("protocol must be scgi or fastcgi")
+    server.send_buffer = config["Server"].getint("send buffer", 0)
+    server.receive_buffer = config["Server"].getint("receive buffer", 0)
     CONFIG["server"] = server
+    ## Event Loop - Installed by server.run in every worker
+    CONFIG["loop"] = config["Server"].get("event loop", common.server.AUTO).strip().lower()
+    if CONFIG["loop"] not in (common.server.AUTO, common.server.UVLOOP, common.server.ASYNCIO):
+        raise ValueError("event loop must be auto, uvloop or asyncio")
+    CONFIG["loop_probe"] = config["Server"].getboolean("startup probe", True)
 
     ## Path Prefix - Set the path prefix when accessed through HTTP
     CONFIG["prefix"] = config["Path"]["prefix"]
+    ## Handler modules for the route table
+    CONFIG["handlers"] = [
+        item.strip() for item in config["Path"].get("handlers", "").split(",") if item.strip()
+    ]
+    CONFIG["exclude"] = [
+        item.strip() for item in config["Path"].get("exclude", "server").split(",") if item.strip()
+    ]
+    ## Static files - Resolved once so handlers can compare real paths
+    CONFIG["static_root"] = config.get("Static", "root", fallback = "")
+    if CONFIG["static_root"]:
+        CONFIG["static_root"] = os.path.realpath(CONFIG["static_root"])
     CONFIG["maxsize"] = {
         "head": config["Tuning"].getint("max head size"),
         "body": config["Tuning"].getint("max body size")
     }
     common.field.MAX_CONTENT_LENGTH = CONFIG["maxsize"]["body"]
+    common.server.STREAM_LIMIT = config["Tuning"].getint("stream limit", common.server.STREAM_LIMIT)
+    common.sysstat.INTERVAL = config["Tuning"].getfloat("stats interval", common.sysstat.INTERVAL)
+    common.multipart.SPOOL_SIZE = config["Tuning"].getint("spool size", common.multipart.SPOOL_SIZE)
+
+    ## Admission Control
+    CONFIG["admission"] = {
+        "max_requests": config["Tuning"].getint("max requests", 1024),
+        "queue_size": config["Tuning"].getint("queue size", 256),
+        "queue_timeout": config["Tuning"].getfloat("queue timeout", 5),
+        "byte_budget": config["Tuning"].getint("buffer budget", 1 << 28)
+    }
+    CONFIG["retry_after"] = config["Tuning"].getint("retry after", 1)
+    CONFIG["backlog"] = config["Tuning"].getint("backlog", 128)
+    CONFIG["timeout"] = {
+        "head": config["Tuning"].getfloat("head timeout", 10),
+        "body": config["Tuning"].getfloat("body timeout", 60)
+    }
+    common.stream.TIMEOUT = CONFIG["timeout"]["body"]
+
+    ## Offload Pools - 0 sizes them from the CPU count
+    common.offload.THREAD_WORKERS = config["Tuning"].getint("offload threads", 0) or None
+    common.offload.PROCESS_WORKERS = config["Tuning"].getint("offload processes", 0) or None
+    common.offload.PARSER_THRESHOLD = config["Tuning"].getint(
+        "parser offload size", common.offload.PARSER_THRESHOLD
+    )
+    common.offload.PARSER_POOL = config["Tuning"].get("parser offload pool", common.offload.PARSER_POOL)
+
+    ## Handler Reload - False disables the watcher, None picks inotify or polling
+    watch = config.get("Reload", "watch", fallback = "no").strip().lower()
+    if watch not in ("auto", "no", common.watch.INOTIFY, common.watch.POLL):
+        raise ValueError("Reload watch must be auto, inotify, poll or no")
+    CONFIG["watch"] = {"auto": None, "no": False}.get(watch, watch)
+    common.watch.POLL_INTERVAL = config.getfloat("Reload", "poll interval", fallback = common.watch.POLL_INTERVAL)
+
+    ## FastCGI Connections
+    common.fastcgi.MAX_REQUESTS = config.getint("FastCGI", "max requests per connection", fallback = common.fastcgi.MAX_REQUESTS)
+    common.fastcgi.IDLE_TIMEOUT = config.getfloat("FastCGI", "idle timeout", fallback = common.fastcgi.IDLE_TIMEOUT)
+    common.fastcgi.MAX_CONNS = CONFIG["admission"]["max_requests"]
+
+    ## Network Classes
+    common.prefix.FILE = config.get("Networks", "file", fallback = "")
+    common.prefix.CHECK_INTERVAL = config.getfloat("Networks", "check interval", fallback = common.prefix.CHECK_INTERVAL)
+
+    ## Sampling Profiler - Toggled at runtime with SIGUSR1 or the flamegraph handler
+    CONFIG["profile"] = config.getboolean("Profiler", "enabled", fallback = False)
+    common.profiler.INTERVAL = config.getfloat("Profiler", "interval", fallback = common.profiler.INTERVAL * 1000) / 1000
+    common.profiler.EVERY = config.getint("Profiler", "every", fallback = common.profiler.EVERY)
+    common.profiler.THRESHOLD = config.getfloat("Profiler", "slow threshold", fallback = common.profiler.THRESHOLD * 1000) / 1000
+    common.profiler.OUTPUT = config.get("Profiler", "output", fallback = common.profiler.OUTPUT)
+
+    ## Response Cache - ttl overrides CACHE_TTL of the handler modules
+    CONFIG["cache_ttl"] = {}
+    if config.has_section("Cache"):
+        section = config["Cache"]
+        for item in section.get("ttl", "").split(","):
+            name, sep, ttl = item.partition("=")
+            if sep:
+                CONFIG["cache_ttl"][name.strip()] = float(ttl)
+        common.respcache.CACHE.maxbytes = section.getint("max bytes", common.respcache.CACHE.maxbytes)
+        common.respcache.MAX_ENTRY = section.getint("max entry size", common.respcache.MAX_ENTRY)
+
+    ## Compression
+    if config.has_section("Compression"):
+        section = config["Compression"]
+        ## Encodings whose module is missing are dropped
+        common.compress.ENCODINGS = [
+            item for item in (
+                entry.strip().lower() for entry in section.get("encodings", "gzip, deflate").split(",")
+            ) if item in common.compress.SUPPORTED
+        ]
+        if "level" in section:
+            common.compress.LEVELS = {item: section.getint("level") for item in common.compress.LEVELS}
+        if "types" in section:
+            common.compress.TYPES = {
+                item.strip().lower() for item in section["types"].split(",") if item.strip()
+            }
+        common.compress.MIN_SIZE = section.getint("min size", common.compress.MIN_SIZE)
+        common.compress.THREAD_SIZE = section.getint("thread size", common.compress.THREAD_SIZE)
+        common.compress.CACHE.maxsize = section.getint("cache entries", common.compress.CACHE.maxsize)
+        common.compress.CACHE_ENTRY_SIZE = section.getint("cache entry size", common.compress.CACHE_ENTRY_SIZE)
+
+    ## WebSocket Sessions
+    if config.has_section("WebSocket"):
+        section = config["WebSocket"]
+        common.websocket.FRAGMENT_SIZE = section.getint("fragment size", common.websocket.FRAGMENT_SIZE)
+        common.websocket.QUEUE_SIZE = section.getint("queue size", common.websocket.QUEUE_SIZE)
+        common.websocket.PING_INTERVAL = section.getfloat("ping interval", common.websocket.PING_INTERVAL)
+        common.websocket.PING_TIMEOUT = section.getfloat("ping timeout", common.websocket.PING_TIMEOUT)
+        common.websocket.MAX_MESSAGE = section.getint("max message size", common.websocket.MAX_MESSAGE)
+        common.hub.POLICY = section.get("slow consumer", common.hub.POLICY).strip().lower()
+        if common.hub.POLICY not in (common.hub.SAMPLE, common.hub.DROP):
+            raise ValueError("slow consumer must be sample or drop")
+        common.websocket.DEFLATE = section.getboolean("permessage deflate", common.websocket.DEFLATE)
+        common.websocket.DEFLATE_LEVEL = section.getint("deflate level", common.websocket.DEFLATE_LEVEL)
+        common.websocket.DEFLATE_MIN_SIZE = section.getint("deflate min size", common.websocket.DEFLATE_MIN_SIZE)
+        ## zlib cannot write raw deflate with 8 window bits
+        common.websocket.DEFLATE_WINDOW_BITS = min(max(
+            section.getint("deflate window bits", common.websocket.DEFLATE_WINDOW_BITS), 9
+        ), 15)
+        common.websocket.DEFLATE_CLIENT_BITS = min(max(
+            section.getint("deflate client window bits", common.websocket.DEFLATE_CLIENT_BITS), 8
+        ), 15)
+        common.websocket.DEFLATE_TAKEOVER = section.getboolean(
+            "deflate context takeover", common.websocket.DEFLATE_TAKEOVER
+        )
+
+    ## Logging
+    common.log.LOG.level = common.log.LEVELS[config.get("Log", "level", fallback = "info").lower()]
+    common.log.ACCESS.stream = common.log.open_stream(config.get("Log", "access log", fallback = ""))
+
+    ## Worker Processes
+    CONFIG["workers"] = config["Tuning"].getint("workers", 1) or os.cpu_count()
+    CONFIG["reuse_port"] = config["Tuning"].getboolean("reuse port", False)
+    CONFIG["drain_timeout"] = config["Tuning"].getfloat("drain timeout", 30)
+    common.startup.BUDGET = config["Tuning"].getfloat("startup budget", common.startup.BUDGET)
 
-load()
 if __name__ == "__main__":
+    load()
     print(CONFIG)
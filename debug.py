@@ -1,7 +1,6 @@
 #!/usr/bin/python3
 
 import asyncio
-import email.policy
 
 import common
 ResponseError = common.ResponseError
@@ -9,24 +8,19 @@ ResponseError = common.ResponseError
 __doc__ = "SCGI Debugger"
 
 async def main(
-    header: email.message.Message,
+    header: common.header.Header,
     stdin: asyncio.streams.StreamReader,
     stdout: asyncio.streams.StreamWriter
 ):
     """ Process HTTP request """
-    common.write_email(
-            req = header,
-            stdout = stdout,
-            resp = email.message_from_string(
-                "Content-Type: text/plain; charset=utf-8\n\nHeaders:\n",
-                policy = email.policy.HTTP
-            )
-    )
-    stdout.write(bytes(header))
-    stdout.write(b"\n\nBody:\n")
     body = await common.parse_data(header, stdin)
+    resp = common.Response(headers = {"Content-Type": "text/plain; charset=utf-8"})
+    resp.write(b"Headers:\n")
+    resp.write(bytes(header))
+    resp.write(b"\n\nBody:\n")
     if isinstance(body, dict):
-        stdout.write(repr(body).encode("utf-8"))
+        resp.write(repr(body))
     else:
-        stdout.write(b"Unsupported body format")
-    stdout.write(b"\n")
+        resp.write(b"Unsupported body format")
+    resp.write(b"\n")
+    await common.send_response(header, stdout, resp)
@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+
+import common
+ResponseError = common.ResponseError
+
+__doc__ = "Sampling profiler control - Collapsed stacks of this worker for flamegraph.pl"
+
+## Only clients from these networks may look at or switch the profiler
+ALLOWED = common.prefix.PrefixIndex((item, "allowed") for item in common.prefix.PRIVATE_NETWORKS)
+
+async def main(header: common.header.Header, _, stdout):
+    """ Main invocation
+
+    ?action=start takes every, threshold (ms) and interval (ms) to override
+    config.ini, stop ends sampling and clear forgets the stacks. The stacks
+    collected so far are returned after the action.
+    """
+    if header["REMOTE_ADDR"] not in ALLOWED:
+        raise ResponseError(403)
+    query = common.field.parse_query(header.get("QUERY_STRING", ""))
+    action = query.get("action")
+    try:
+        if action == "start":
+            common.profiler.start(
+                int(query["every"]) if "every" in query else None,
+                float(query["threshold"]) / 1000 if "threshold" in query else None,
+                float(query["interval"]) / 1000 if "interval" in query else None
+            )
+        elif action == "stop":
+            common.profiler.stop()
+        elif action == "clear":
+            common.profiler.PROFILER.clear()
+        elif action is not None:
+            raise ResponseError(400, "Unknown action " + repr(action))
+    except ValueError as err:
+        raise ResponseError(400, str(err)) from err
+    await common.send_response(header, stdout, common.Response(
+        headers = {
+            "Content-Type": "text/plain; charset=utf-8",
+            "X-Profiler": "running" if common.profiler.ACTIVE is not None else "stopped"
+        },
+        body = common.profiler.PROFILER.collapsed()
+    ))
@@ -0,0 +1,308 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import base64
+import os
+import time
+
+from common import fastcgi
+
+__doc__ = "SCGI load generator speaking raw netstrings, or FastCGI records, to server.py"
+
+def build_request(env: dict, body: bytes = b"") -> bytes:
+    """ Encode CGI variables and body as an SCGI request """
+    env = dict(env)
+    ## CONTENT_LENGTH must come first
+    head = [("CONTENT_LENGTH", str(len(body))), ("SCGI", "1")]
+    head += [item for item in env.items() if item[0] not in ("CONTENT_LENGTH", "SCGI")]
+    data = b"".join(
+        item[0].encode("utf-8") + b"\0" + str(item[1]).encode("utf-8") + b"\0" for item in head
+    )
+    return b"".join((str(len(data)).encode("ascii"), b":", data, b",", body))
+
+def build_fastcgi(env: dict, body: bytes = b"") -> bytes:
+    """ Encode CGI variables and body as FastCGI request 1 on a kept connection """
+    env = dict(env, CONTENT_LENGTH = str(len(body)))
+    data = fastcgi.records(fastcgi.BEGIN_REQUEST, 1, bytes((0, fastcgi.RESPONDER, fastcgi.KEEP_CONN)) + bytes(5))
+    data += fastcgi.records(fastcgi.PARAMS, 1, fastcgi.encode_params(env)) + fastcgi.records(fastcgi.PARAMS, 1)
+    if body:
+        data += fastcgi.records(fastcgi.STDIN, 1, body)
+    data += fastcgi.records(fastcgi.STDIN, 1)
+    return b"".join(bytes(item) for item in data)
+
+def base_env(uri: str, method: str = "GET", extra: int = 0) -> dict:
+    """ Variables nginx would send, plus extra HTTP_X_ ones to grow the header """
+    path, _, query = uri.partition("?")
+    env = {
+        "REQUEST_METHOD": method,
+        "REQUEST_URI": uri,
+        "DOCUMENT_URI": path,
+        "QUERY_STRING": query,
+        "CONTENT_TYPE": "",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "REMOTE_ADDR": "127.0.0.1",
+        "REMOTE_PORT": "40000",
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "HTTP_HOST": "localhost",
+        "HTTP_USER_AGENT": "StaphScgi-loadgen/0.1",
+        "HTTP_ACCEPT": "*/*"
+    }
+    env.update({"HTTP_X_LOAD_" + str(item): "v" * 16 for item in range(extra)})
+    return env
+
+def multipart_body(size: int, boundary: str = "StaphScgiLoadBoundary") -> tuple:
+    """ A form with one text field and one file of size bytes """
+    body = b"".join((
+        b"--", boundary.encode("ascii"), b"\r\n",
+        b'Content-Disposition: form-data; name="note"\r\n\r\nload test\r\n',
+        b"--", boundary.encode("ascii"), b"\r\n",
+        b'Content-Disposition: form-data; name="file"; filename="load.bin"\r\n',
+        b"Content-Type: application/octet-stream\r\n\r\n",
+        os.urandom(size),
+        b"\r\n--", boundary.encode("ascii"), b"--\r\n"
+    ))
+    return "multipart/form-data; boundary=" + boundary, body
+
+def websocket_body() -> bytes:
+    """ A masked text frame followed by a close frame """
+    mask = os.urandom(4)
+    text = bytes(item ^ mask[idx & 3] for idx, item in enumerate(b"load test"))
+    return b"\x81" + bytes((0x80 | 9,)) + mask + text + b"\x88\x80" + os.urandom(4)
+
+def scenario(name: str, prefix: str = "/scgi", extra: int = 0, body_size: int = 1 << 16) -> tuple:
+    """ Return (env, body, trailer) of a canned scenario - trailer follows the body """
+    body = b""
+    if name == "debug":
+        env = base_env(prefix + "/debug?a=1&b=2", extra = extra)
+    elif name == "sysinfo":
+        env = base_env(prefix + "/sysinfo", extra = extra)
+    elif name == "websocket":
+        env = base_env(prefix + "/websocket", extra = extra)
+        env["HTTP_UPGRADE"] = "websocket"
+        env["HTTP_CONNECTION"] = "Upgrade"
+        env["HTTP_SEC_WEBSOCKET_KEY"] = base64.b64encode(os.urandom(16)).decode("ascii")
+        env["HTTP_SEC_WEBSOCKET_VERSION"] = "13"
+        ## Frames follow the header, outside CONTENT_LENGTH
+        return env, b"", websocket_body()
+    elif name == "upload":
+        env = base_env(prefix + "/debug", "POST", extra = extra)
+        env["CONTENT_TYPE"], body = multipart_body(body_size)
+    elif name == "notfound":
+        env = base_env(prefix + "/no/such/route", extra = extra)
+    else:
+        raise ValueError("Unknown scenario " + name)
+    return env, body, b""
+
+SCENARIOS = ("debug", "sysinfo", "websocket", "upload", "notfound")
+
+class MemoryTransport(asyncio.Transport):
+    " Transport collecting what the server writes "
+    def __init__(self, protocol):
+        super().__init__()
+        self.protocol = protocol
+        self.data = bytearray()
+        self.closed = False
+    def write(self, data):
+        self.data += data
+    def writelines(self, list_of_data):
+        for item in list_of_data:
+            self.data += item
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.protocol.connection_lost(None)
+    def is_closing(self) -> bool:
+        return self.closed
+    def get_extra_info(self, name, default=None):
+        return default
+    def get_write_buffer_size(self) -> int:
+        return 0
+
+async def request_inprocess(handle, data: bytes) -> bytes:
+    """ Call the server handler on paired in-memory streams """
+    stdin = asyncio.StreamReader()
+    stdin.feed_data(data)
+    stdin.feed_eof()
+    protocol = asyncio.StreamReaderProtocol(asyncio.StreamReader())
+    transport = MemoryTransport(protocol)
+    protocol.connection_made(transport)
+    stdout = asyncio.StreamWriter(transport, protocol, stdin, asyncio.get_running_loop())
+    await handle(stdin, stdout)
+    return bytes(transport.data)
+
+async def request_socket(target: tuple, data: bytes) -> bytes:
+    """ Send the request over a new connection and read until the server closes """
+    if target[0] == "unix":
+        stdin, stdout = await asyncio.open_unix_connection(target[1])
+    else:
+        stdin, stdout = await asyncio.open_connection(target[1], target[2])
+    try:
+        stdout.write(data)
+        await stdout.drain()
+        return await stdin.read()
+    finally:
+        stdout.close()
+
+class FastCGIPool():
+    """ Persistent FastCGI connections, each carrying one request at a time
+
+    Like nginx with fastcgi_keep_conn, a connection goes back to the pool
+    once the END_REQUEST record of its request arrived.
+    """
+    def __init__(self, target: tuple):
+        self.target = target
+        self.free = []
+    def __repr__(self) -> str:
+        return "<FastCGIPool free=" + str(len(self.free)) + " />"
+    async def send(self, data: bytes) -> bytes:
+        """ Send the request and return its STDOUT """
+        if self.free:
+            stdin, stdout = self.free.pop()
+        elif self.target[0] == "unix":
+            stdin, stdout = await asyncio.open_unix_connection(self.target[1])
+        else:
+            stdin, stdout = await asyncio.open_connection(self.target[1], self.target[2])
+        try:
+            stdout.write(data)
+            await stdout.drain()
+            result = bytearray()
+            while True:
+                _, kind, _, size, padding = fastcgi.HEADER.unpack(await stdin.readexactly(fastcgi.HEADER.size))
+                content = await stdin.readexactly(size + padding)
+                if kind == fastcgi.STDOUT:
+                    result += content[:size]
+                elif kind == fastcgi.END_REQUEST:
+                    break
+        except (OSError, asyncio.IncompleteReadError):
+            stdout.close()
+            raise
+        self.free.append((stdin, stdout))
+        return bytes(result)
+
+def status_of(data: bytes) -> int:
+    """ Status code from the response """
+    if data[:8] != b"Status: ":
+        return 0
+    try:
+        return int(data[8:11])
+    except ValueError:
+        return 0
+
+def percentile(values: list, fraction: float) -> float:
+    """ Value at the fraction of the sorted values """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+async def run(send, data: bytes, concurrency: int, count: int = 0, duration: float = 0) -> dict:
+    """ Drive send(data) from concurrency workers and collect latencies """
+    latencies = []
+    status = {}
+    errors = 0
+    issued = 0
+    deadline = time.perf_counter() + duration if duration else None
+
+    async def worker():
+        nonlocal errors, issued
+        while True:
+            if deadline is not None:
+                if time.perf_counter() >= deadline:
+                    return
+            elif issued >= count:
+                return
+            issued += 1
+            start = time.perf_counter()
+            try:
+                code = status_of(await send(data))
+            except (OSError, asyncio.IncompleteReadError):
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            status[code] = status.get(code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "p999": percentile(latencies, 0.999),
+        "status": status
+    }
+
+def report(name: str, result: dict):
+    """ Print one result line """
+    print(
+        name.ljust(10),
+        ("%.0f req/s" % result["throughput"]).rjust(12),
+        "p50", ("%.3f ms" % (result["p50"] * 1000)).rjust(10),
+        "p99", ("%.3f ms" % (result["p99"] * 1000)).rjust(10),
+        "p999", ("%.3f ms" % (result["p999"] * 1000)).rjust(10),
+        "errors", result["errors"],
+        "status", " ".join(str(item[0]) + "x" + str(item[1]) for item in sorted(result["status"].items()))
+    )
+
+async def amain(args):
+    """ Run the selected scenarios """
+    build = build_request
+    if args.protocol == "fastcgi":
+        build = build_fastcgi
+        if args.target.startswith("unix:"):
+            send = FastCGIPool(("unix", args.target[5:])).send
+        else:
+            host, _, port = args.target.rpartition(":")
+            send = FastCGIPool(("tcp", host or "127.0.0.1", int(port))).send
+    elif args.target == "inprocess":
+        import server #pylint: disable=import-outside-toplevel
+        server.setup()
+        server.ROUTER.reload()
+        send = lambda data: request_inprocess(server.handle, data)
+    elif args.target.startswith("unix:"):
+        target = ("unix", args.target[5:])
+        send = lambda data: request_socket(target, data)
+    else:
+        host, _, port = args.target.rpartition(":")
+        target = ("tcp", host or "127.0.0.1", int(port))
+        send = lambda data: request_socket(target, data)
+    for name in args.scenario or SCENARIOS:
+        env, body, trailer = scenario(name, args.prefix, args.headers, args.body_size)
+        if trailer and build is build_fastcgi:
+            print(name.ljust(10), "needs a connection upgrade, which FastCGI cannot carry")
+            continue
+        if args.content_type:
+            env["CONTENT_TYPE"] = args.content_type
+        data = build(env, body) + trailer
+        report(name, await run(send, data, args.concurrency, args.requests, args.duration))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("scenario", nargs = "*", help = "Scenarios to run, all by default: " + ", ".join(SCENARIOS))
+    parser.add_argument(
+        "-t", "--target", default = "inprocess",
+        help = "host:port, unix:/path, or inprocess to call server.handle directly (default)"
+    )
+    parser.add_argument(
+        "-p", "--protocol", choices = ("scgi", "fastcgi"), default = "scgi",
+        help = "Protocol of the target, fastcgi keeps one connection per concurrent client (default scgi)"
+    )
+    parser.add_argument("-c", "--concurrency", type = int, default = 32, help = "Concurrent connections")
+    parser.add_argument("-n", "--requests", type = int, default = 2000, help = "Requests per scenario")
+    parser.add_argument("-d", "--duration", type = float, default = 0, help = "Seconds per scenario instead of -n")
+    parser.add_argument("-H", "--headers", type = int, default = 0, help = "Extra CGI variables per request")
+    parser.add_argument("-b", "--body-size", type = int, default = 1 << 16, help = "File size of the upload scenario")
+    parser.add_argument("--content-type", help = "Override CONTENT_TYPE")
+    parser.add_argument("--prefix", default = "/scgi", help = "Path prefix configured in config.ini")
+    arguments = parser.parse_args()
+    for entry in arguments.scenario:
+        if entry not in SCENARIOS:
+            parser.error("unknown scenario " + entry)
+    if arguments.protocol == "fastcgi" and arguments.target == "inprocess":
+        parser.error("fastcgi needs a host:port or unix: target")
+    asyncio.run(amain(arguments))
@@ -0,0 +1,18 @@
+#!/usr/bin/python3
+
+import common
+ResponseError = common.ResponseError
+
+__doc__ = "Request and broadcast metrics of this worker in Prometheus text format"
+
+## Only clients from these networks may scrape the metrics
+ALLOWED = common.prefix.PrefixIndex((item, "allowed") for item in common.prefix.PRIVATE_NETWORKS)
+
+async def main(header: common.header.Header, _, stdout):
+    """ Main invocation """
+    if header["REMOTE_ADDR"] not in ALLOWED:
+        raise ResponseError(403)
+    await common.send_response(header, stdout, common.Response(
+        headers = {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        body = common.metrics.render() + common.hub.render()
+    ))
@@ -1,36 +1,63 @@
 #!/usr/bin/python3
+import os
 import sys
+import time
+
+if sys.version_info < (3, 9):
+    raise NotImplementedError("This program requires Python 3.9")
 
-if sys.version_info.major < 3:
-    raise NotImplementedError("This program requires Python 3")
+## Process start, the reference of --startup-profile
+STARTED = time.monotonic()
+if __name__ == "__main__" and "--startup-profile" in sys.argv and "SCGI_STARTUP_PROFILE" not in os.environ:
+    ## Restart under -X importtime with its report going to a fresh file,
+    ## not a predictable path, keeping a copy of the real stderr to restore
+    ## once started
+    import tempfile
+    LOG_FD, IMPORT_LOG = tempfile.mkstemp(prefix = "scgi-importtime-")
+    STDERR = os.dup(2)
+    os.set_inheritable(STDERR, True)
+    os.environ["SCGI_STARTUP_PROFILE"] = ",".join((IMPORT_LOG, str(STDERR), repr(STARTED)))
+    os.dup2(LOG_FD, 2)
+    os.close(LOG_FD)
+    os.execv(sys.executable, [sys.executable, "-X", "importtime"] + sys.argv)
 
 # pylint: disable=wrong-import-position
 # as we are doing some version check before importing everything
 
 import asyncio
-import email.parser
-import email.policy
-import importlib
-import os
 import signal
+import socket
 
 import common
 import config
 ResponseError = common.ResponseError
 
-__doc__ = "SCGI Server based on email module for header - content processing"
+__doc__ = "SCGI Server based on asyncio streams"
 
-PATH_PREFIX = config.CONFIG["prefix"]
+## Defaults until setup() applies config.ini
+PATH_PREFIX = "/scgi"
 ## 1 MiB Header Limit
-MAX_HEAD_LEN = config.CONFIG["maxsize"]["head"]
-AVAIL_MOD = {}
+MAX_HEAD_LEN = 1 << 20
+## Handler modules - Built before serving, rebuilt on SIGHUP
+ROUTER = common.router.Router()
+## Connection handlers still running
+ACTIVE = set()
+ADMISSION = common.admission.Admission()
+RETRY_AFTER = {"Retry-After": "1"}
+## Variables every request must carry
+REQUIRED = ("CONTENT_LENGTH", "REQUEST_METHOD", "REQUEST_URI", "HTTP_USER_AGENT")
+## Startup phases when run with --startup-profile
+PROFILE = None
 
 async def process_request(
-    header: email.message.Message,
+    header: common.header.Header,
     stdin: asyncio.streams.StreamReader,
     stdout: asyncio.streams.StreamWriter
 ):
-    """ Process HTTP request - Router"""
+    """ Process HTTP request - Router
+
+    Returns the name of the route that handled it, None when not found.
+    """
     path = os.path.normpath(
         "DOCUMENT_URI" in header
         and header["DOCUMENT_URI"]
@@ -42,111 +69,382 @@ async def process_request(
     modname = path[1:].split(".",1)[0].split("/",1)[0]
     if path in "/":
         modname = "index"
-    if os.path.isfile(modname+".py") or os.path.isdir(modname):
+    target = ROUTER.get(modname)
+    if target is not None:
         ## External handler
-        if modname not in AVAIL_MOD:
-            target = importlib.import_module(modname)
-            AVAIL_MOD[modname] = target.main
-        target = AVAIL_MOD[modname]
         try:
-            await target(header, stdin, stdout)
+            if common.profiler.ACTIVE is None:
+                await target(header, stdin, stdout)
+            else:
+                await common.profiler.ACTIVE.run(modname, target(header, stdin, stdout))
         except Exception as err: #pylint: disable=broad-except
             if isinstance(err, ResponseError):
                 err.write( req = header, stdout = stdout )
             else:
-                common.write_email(
+                common.write_response(
                     req = header,
                     stdout = stdout,
-                    status = 400,
-                    resp = email.message_from_string(
-                        "Content-Type: text/plain; charset=utf-8"+str(err),
-                        policy = email.policy.HTTP
-                    )
+                    resp = common.Response(400, body = str(err))
                 )
-            print(type(err))
-            print(repr(err))
-    else:
-        common.write_email(
-            req = header,
-            stdout = stdout,
-            status = 404,
-            resp = email.message_from_string(
-                "Content-Type: text/plain; charset=utf-8\n\n"
-                "File not found: " + path,
-                policy = email.policy.HTTP
-            )
-        )
+            common.log.warning(modname, type(err).__name__, repr(err))
+        return modname
+    common.write_response(
+        req = header,
+        stdout = stdout,
+        resp = common.Response(404, body = "File not found: " + path)
+    )
+    return None
+
+async def read_head(stdin: asyncio.streams.StreamReader, reserved: list) -> bytes:
+    """ Read the header netstring, reserving its size from the byte budget """
+    try:
+        data = await stdin.readuntil(b":")
+        data = data[:-1]
+        headlen = int(data)
+        if headlen > MAX_HEAD_LEN:
+            raise ResponseError(431, "Payload head too large")
+        if not ADMISSION.reserve(headlen):
+            raise ResponseError(503, headers = RETRY_AFTER)
+        reserved[0] = headlen
+        data = await stdin.readexactly(headlen+1)
+        if data[-1:] != b",":
+            raise ResponseError(400, "Payload malformed")
+    except asyncio.LimitOverrunError as err:
+        raise ResponseError(431, "Payload too large") from err
+    except asyncio.IncompleteReadError as err:
+        raise ResponseError(413, "Payload malformed") from err
+    except ValueError as err:
+        raise ResponseError(400, "Payload malformed") from err
+    return data
 
 async def handle(stdin, stdout):
     """ Socket connection handler """
+    started = time.perf_counter()
+    stdout = common.metrics.CountingWriter(stdout)
+    header = None
+    route = None
+    ## Bytes taken from the budget - header, then header and body
+    reserved = [0]
     try:
         try:
-            data = await stdin.readuntil(b":")
-            data = data[:-1]
-            headlen = int(data)
-            if headlen > MAX_HEAD_LEN:
-                raise ResponseError(431, "Payload head too large")
-            data = await stdin.readexactly(headlen+1)
-            data = data[:-2]
-        except asyncio.LimitOverrunError as err:
-            raise ResponseError(431, "Payload too large") from err
-        except asyncio.IncompleteReadError as err:
-            raise ResponseError(413, "Payload malformed") from err
-        except ValueError as err:
-            raise ResponseError(400, "Payload malformed") from err
-        data = data.split(b"\0")
-        data = [data[item << 1:1 + item << 1] for item in range(len(data) >> 1)]
-        data = b"\n".join((b": ".join(item) for item in data))
-    ## Now we can parse the header
-        parser = email.parser.BytesParser(policy = email.policy.default)
-        header = parser.parsebytes(data, headersonly=True)
-    except ResponseError as err:
-        err.write(None, stdout)
+            timer = common.stream.deadline(stdin, config.CONFIG["timeout"]["head"])
+            try:
+                data = await read_head(stdin, reserved)
+            except TimeoutError as err:
+                ## Slow or idle client
+                raise ResponseError(408) from err
+            finally:
+                timer.cancel()
+        ## Now we can parse the header
+            header = common.parse_header(memoryview(data)[:-1])
+            del data
+            body = common.field.buffered_size(header)
+            if not ADMISSION.reserve(body):
+                raise ResponseError(503, headers = RETRY_AFTER)
+            reserved[0] += body
+        except ResponseError as err:
+            err.write(header, stdout)
+            header = None
+        parsed = handled = time.perf_counter()
+        ## Stop the try here for errors without header
+        if header is not None:
+            try:
+                if False in (entry in header for entry in REQUIRED + ("SCGI",)) or header["SCGI"] != "1":
+                    common.log.debug("\n".join((": ".join(item) for item in header.items())))
+                    raise ResponseError(400, "Payload head missing value")
+                ## Header parsed. Now process the entity with the processor.
+                route = await process_request(header, stdin, stdout)
+            except ResponseError as err:
+                err.write(header, stdout)
+            handled = time.perf_counter()
+        await finish(header, stdout, route, reserved[0], (started, parsed, handled))
+    finally:
+        ## Also when the client went away or a handler escaped process_request
+        ADMISSION.free(reserved[0])
+
+async def handle_fastcgi(header, stdin, stdout):
+    """ FastCGI request handler - common.fastcgi owns the connection
+
+    Admission is per request here, as one connection carries many.
+    """
+    started = time.perf_counter()
+    stdout = common.metrics.CountingWriter(stdout)
+    route = None
+    reserved = 0
+    acquired = await ADMISSION.acquire()
+    try:
         try:
-            await stdout.drain()
-        except ConnectionError:
-            print(str(err))
-        await common.close_connection(stdout)
-        return
-    ## Stop the try here for errors without header
+            if not acquired:
+                raise ResponseError(503, headers = RETRY_AFTER)
+            ## nginx sends an empty CONTENT_LENGTH without a body
+            if not header["CONTENT_LENGTH"]:
+                header["CONTENT_LENGTH"] = "0"
+            if False in (entry in header for entry in REQUIRED):
+                common.log.debug("\n".join((": ".join(item) for item in header.items())))
+                raise ResponseError(400, "Payload head missing value")
+            body = common.field.buffered_size(header)
+            if not ADMISSION.reserve(body):
+                raise ResponseError(503, headers = RETRY_AFTER)
+            reserved = body
+        except ResponseError as err:
+            err.write(header, stdout)
+            header = None
+        parsed = handled = time.perf_counter()
+        if header is not None:
+            try:
+                route = await process_request(header, stdin, stdout)
+            except ResponseError as err:
+                err.write(header, stdout)
+            handled = time.perf_counter()
+        await finish(header, stdout, route, reserved, (started, parsed, handled))
+    finally:
+        ADMISSION.free(reserved)
+        if acquired:
+            ADMISSION.release()
+
+async def finish(header, stdout, route: str, reserved: int, timing: tuple):
+    """ Flush and close the response, then account for it
+
+    timing holds the perf_counter values at the start, once parsed and
+    once handled.
+    """
+    started, parsed, handled = timing
     try:
-        if False in (entry in header for entry in (
-            "CONTENT_LENGTH",
-            "REQUEST_METHOD",
-            "REQUEST_URI",
-            "HTTP_USER_AGENT",
-            "SCGI"
-        )) or header["SCGI"] != "1":
-            print("\n".join((": ".join(item) for item in header.items())))
-            raise ResponseError(400, "Payload head missing value")
-        ## Compatibility to Email
-        header["Content-Type"] = header.get("content_type")
-        ## Header parsed. Now process the entity with the processor.
-        await process_request(header, stdin, stdout)
         await stdout.drain()
-    except ResponseError as err:
-        err.write(header, stdout)
     except ConnectionError:
-        print("Error returning request:", header)
+        common.log.warning("Error returning request:", header and header.get("REQUEST_URI"))
     await common.close_connection(stdout)
+    finished = time.perf_counter()
+    try:
+        bytes_in = int(header["CONTENT_LENGTH"]) + reserved - common.field.buffered_size(header)
+    except (TypeError, ValueError):
+        bytes_in = reserved
+    common.metrics.record(
+        route, stdout.status or 0, bytes_in, stdout.bytes_out,
+        (parsed - started, handled - parsed, finished - handled)
+    )
+    if header is not None:
+        common.log.access(header, stdout.status or 0, stdout.bytes_out, finished - started)
 
-async def main():
+async def serve_client(stdin, stdout):
+    """ Track the connection handler so shutdown can drain it """
+    task = asyncio.current_task()
+    ACTIVE.add(task)
+    try:
+        if await ADMISSION.acquire():
+            try:
+                await handle(stdin, stdout)
+            finally:
+                ADMISSION.release()
+        else:
+            ## Overloaded - Answer without reading the request
+            ResponseError(503, headers = RETRY_AFTER).write(None, stdout)
+            common.metrics.record(None, 503, 0, 0, (0, 0, 0))
+            await common.close_connection(stdout)
+    finally:
+        ACTIVE.discard(task)
+
+async def serve_fastcgi(stdin, stdout):
+    """ Serve the requests of a FastCGI connection until it closes """
+    task = asyncio.current_task()
+    ACTIVE.add(task)
+    try:
+        await common.fastcgi.Connection(
+            stdin, stdout, handle_fastcgi, MAX_HEAD_LEN, common.server.STREAM_LIMIT
+        ).serve()
+    finally:
+        ACTIVE.discard(task)
+
+def reload(paths: list = None):
+    """ Reload the handlers whose source changed, every handler on SIGHUP """
+    sources = ROUTER.sources()
+    ROUTER.reload(None if paths is None else {sources[item] for item in paths if item in sources})
+    ## Pool processes were forked with the old handler modules
+    common.offload.recycle_processes()
+    WATCHER.watch(ROUTER.sources())
+
+## Handler source watcher, started by main when configured
+WATCHER = common.watch.Watcher(reload, False)
+
+def setup(path: str = "config.ini"):
+    """ Load the configuration and build the server state from it """
+    global PATH_PREFIX, MAX_HEAD_LEN, ROUTER, ADMISSION, RETRY_AFTER #pylint: disable=global-statement
+    config.load(path)
+    PATH_PREFIX = config.CONFIG["prefix"]
+    MAX_HEAD_LEN = config.CONFIG["maxsize"]["head"]
+    ROUTER = common.router.Router(
+        preload = config.CONFIG["handlers"],
+        exclude = config.CONFIG["exclude"],
+        cache_ttl = config.CONFIG["cache_ttl"]
+    )
+    ADMISSION = common.admission.Admission(**config.CONFIG["admission"])
+    RETRY_AFTER = {"Retry-After": str(config.CONFIG["retry_after"])}
+    WATCHER.method = config.CONFIG["watch"]
+
+async def main(sock: socket.socket = None):
     """ Main function for invocation via cmdline """
-    server = await config.CONFIG["server"].start(handle)
-    print("Started", config.CONFIG["server"])
+    client = serve_fastcgi if config.CONFIG["server"].protocol == common.server.FASTCGI else serve_client
+    server = await config.CONFIG["server"].start(
+        client, sock = sock, backlog = config.CONFIG["backlog"]
+    )
+    common.log.info("Started", config.CONFIG["server"], "pid", os.getpid())
+    if PROFILE is not None:
+        ## Listening with the loop running - the next iteration accepts
+        PROFILE.mark("accepting")
+        server.close()
+        await server.wait_closed()
+        return
+    if config.CONFIG["loop_probe"]:
+        result = await common.server.probe()
+        common.log.info(
+            "Event loop", config.CONFIG["loop"],
+            "stream limit", common.server.STREAM_LIMIT,
+            "nodelay", getattr(config.CONFIG["server"], "nodelay", None),
+            "send buffer", config.CONFIG["server"].send_buffer or "default",
+            "receive buffer", config.CONFIG["server"].receive_buffer or "default",
+            "- %.0f callbacks/s, %.1f us round trip" % (result["callbacks_per_second"], result["round_trip_us"])
+        )
     stop_request = asyncio.Event()
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
     loop.add_signal_handler(signal.SIGINT, stop_request.set)
+    loop.add_signal_handler(signal.SIGTERM, stop_request.set)
+    loop.add_signal_handler(signal.SIGHUP, reload)
+    loop.add_signal_handler(signal.SIGUSR1, common.profiler.toggle)
+    if config.CONFIG["profile"]:
+        common.profiler.start()
+    if config.CONFIG["watch"] is not False:
+        WATCHER.start(ROUTER.sources())
+        common.log.info("Watching handlers with", WATCHER.method)
     await stop_request.wait()
+    WATCHER.stop()
+    common.profiler.stop()
     server.close()
-    if sys.version_info.minor >= 7:
-        await server.wait_closed()
-    print("Stopped", config.CONFIG["server"])
+    ## Persistent FastCGI connections close once their requests end
+    common.fastcgi.shutdown()
+    ## Let in-flight requests finish before leaving, then cancel the rest
+    ## - wait_closed waits for every client connection since Python 3.12
+    if ACTIVE:
+        common.log.info("Draining", len(ACTIVE), "connections")
+        _, pending = await asyncio.wait(set(ACTIVE), timeout = config.CONFIG["drain_timeout"])
+        if pending:
+            common.log.warning("Cancelling", len(pending), "connections")
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending, timeout = 1)
+    try:
+        await asyncio.wait_for(server.wait_closed(), 1)
+    except asyncio.TimeoutError:
+        pass
+    common.offload.shutdown()
+    common.log.info("Stopped", config.CONFIG["server"], "pid", os.getpid())
+    common.log.flush()
+    common.log.ACCESS.flush()
+
+def run(coro):
+    """ Run the coroutine on a fresh event loop of the configured kind """
+    config.CONFIG["loop"] = common.server.use_loop(config.CONFIG["loop"])
+    asyncio.run(coro)
+
+def run_worker(sock: socket.socket = None):
+    """ Worker process body - never returns """
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+    status = 0
+    try:
+        if sock is None:
+            ## SO_REUSEPORT - Every worker owns a socket and the kernel balances
+            sock = config.CONFIG["server"].bind(reuse_port = True, backlog = config.CONFIG["backlog"])
+        run(main(sock))
+    except Exception: #pylint: disable=broad-except
+        common.log.exception("Worker", os.getpid(), "failed")
+        status = 1
+    finally:
+        common.log.flush()
+        common.log.ACCESS.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+def supervise(workers: int):
+    """ Pre-fork workers on a shared socket and keep them alive """
+    reuse_port = config.CONFIG["reuse_port"] and isinstance(config.CONFIG["server"], common.server.NetServer)
+    sock = None if reuse_port else config.CONFIG["server"].bind(backlog = config.CONFIG["backlog"])
+    children = {}
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            run_worker(sock)
+        children[pid] = time.monotonic()
+
+    def forward(signum, _):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(signum, _):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM if signum == signal.SIGINT else signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGHUP, forward)
+    signal.signal(signal.SIGUSR1, forward)
+    common.log.info("Supervisor", os.getpid(), "starting", workers, "workers")
+    for _ in range(workers):
+        spawn()
+    while children:
+        pid, status = os.wait()
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        common.log.warning("Worker", pid, "exited with status", os.waitstatus_to_exitcode(status))
+        if time.monotonic() - started < 1:
+            ## Avoid spinning on a worker that dies at startup
+            time.sleep(1)
+        if not stopping:
+            spawn()
+    if sock is not None:
+        sock.close()
+    common.log.info("Supervisor", os.getpid(), "stopped")
 
 if __name__ == "__main__":
-    if sys.version_info.minor < 7:
-        el = asyncio.get_event_loop()
-        el.run_until_complete(main())
-        el.close()
+    arguments = {"config": "config.ini", "startup_profile": False}
+    if sys.argv[1:]:
+        ## argparse weighs more than the rest of the startup path, skip it without options
+        import argparse
+        parser = argparse.ArgumentParser(description = __doc__)
+        parser.add_argument("--config", default = "config.ini", help = "Configuration file (default config.ini)")
+        parser.add_argument(
+            "--startup-profile", action = "store_true",
+            help = "Report import times and the time until accepting, then exit"
+        )
+        arguments = vars(parser.parse_args())
+    if arguments["startup_profile"]:
+        PROFILE = common.startup.Profile.from_env(STARTED)
+        PROFILE.mark("imports")
+    setup(arguments["config"])
+    if PROFILE is not None:
+        PROFILE.mark("config")
+    ## Import handlers once so forked workers share them
+    ROUTER.reload()
+    if PROFILE is not None:
+        PROFILE.mark("handlers")
+        run(main())
+        within = PROFILE.report()
+        common.log.flush()
+        sys.exit(0 if within else 1)
+    elif config.CONFIG["workers"] > 1:
+        supervise(config.CONFIG["workers"])
     else:
-        asyncio.run(main())
+        run(main())
@@ -0,0 +1,27 @@
+#!/usr/bin/python3
+
+import asyncio
+import os
+
+import common
+import config
+
+__doc__ = "Static file downloads served with sendfile"
+
+async def main(
+    header: common.header.Header,
+    _,
+    stdout: asyncio.streams.StreamWriter
+):
+    """ Serve the file below the static root named by the rest of the path """
+    if header["REQUEST_METHOD"] not in ("GET", "HEAD"):
+        raise common.ResponseError(405, headers = {"Allow": "GET, HEAD"})
+    root = config.CONFIG["static_root"]
+    if not root:
+        raise common.ResponseError(404, "File not found")
+    ## DOCUMENT_URI is /static/<path> at this point
+    relpath = header["DOCUMENT_URI"].split("/", 2)[2:]
+    path = os.path.realpath(os.path.join(root, relpath[0] if relpath else ""))
+    if not path.startswith(os.path.join(root, "")):
+        raise common.ResponseError(404, "File not found")
+    await common.send_file(header, stdout, path)
@@ -1,9 +1,9 @@
 #!/usr/bin/python3
 
-import email.policy
-import geoip2.database
 import ipaddress
-import subprocess
+import json
+import os
+import time
 
 import common
 
@@ -34,8 +34,77 @@ TRUSTED_NETWORK = {
     ipaddress.ip_network("fd42::/16")
 }
 
+## Client classes by most specific network, prefixes of [Networks] file on top
+NETWORKS = common.prefix.PrefixFile(base = [(item, "private") for item in common.prefix.PRIVATE_NETWORKS]
+    + [(item, "trusted") for item in TRUSTED_NETWORK]
+    + [(item, "own") for item in MY_NETWORK]
+    + [(item, "own") for item in common.prefix.LOOPBACK_NETWORKS]
+)
+## Classes greeted without a database lookup
+GREETINGS = {
+    "own": "Welcome, our privileged StaphNet user!",
+    "trusted": "Welcome, our privileged peering member!",
+    "private": "Welcome to StaphNet, my unknown friend!"
+}
+
+## System metrics, refreshed in the background
+SAMPLER = common.sysstat.Sampler()
+
+def cache_vary(header) -> tuple:
+    """ Share the metrics JSON, the HTML page shows per client details """
+    return () if header["DOCUMENT_URI"].endswith(".json") else None
+
+## Response cache - See common.respcache
+CACHE_TTL = 1
+CACHE_VARY = cache_vary
+## Warm state handed over when the module is reloaded
+RELOAD_KEEP = ("SAMPLER", "CITY_DB", "ASN_DB", "GEOIP_CACHE")
+
 DATABASE_ATTRIBUTION = "\n* IP Geolocation by DB-IP <https://db-ip.com>"
 
+class GeoIPDatabase():
+    """ geoip2 Reader opened once in MODE_MMAP
+
+    The file mtime is checked at most every check_interval seconds and the
+    reader is reopened when it changed. Call reader from the event loop: the
+    previous reader is left to the lookups still holding it, and goes away
+    with the last of them.
+    """
+    def __init__(self, path: str, check_interval: float = 5):
+        self.path = path
+        self.check_interval = check_interval
+        self._reader = None
+        self._mtime = None
+        self._checked = 0
+    def __repr__(self) -> str:
+        return '<GeoIPDatabase path="' + self.path + '" />'
+    def reader(self) -> "geoip2.database.Reader":
+        "Return the current reader, reopening it if the file was replaced"
+        ## Imported on first lookup, it weighs on startup
+        import geoip2.database #pylint: disable=import-outside-toplevel
+        now = time.monotonic()
+        if self._reader is not None and now - self._checked < self.check_interval:
+            return self._reader
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            if self._reader is None:
+                raise
+            ## Keep serving while the file is being replaced
+            return self._reader
+        if mtime != self._mtime:
+            self._reader = geoip2.database.Reader(self.path, mode = geoip2.database.MODE_MMAP)
+            self._mtime = mtime
+            ## Results from the previous database are stale
+            GEOIP_CACHE.clear()
+        return self._reader
+
+CITY_DB = GeoIPDatabase("/usr/share/GeoIP/city.mmdb")
+ASN_DB = GeoIPDatabase("/usr/share/GeoIP/asn.mmdb")
+## Formatted lookup results by address
+GEOIP_CACHE = common.cache.LRUCache(maxsize = 4096, ttl = 3600)
+
 def geoip2_asn(result) -> str:
     if result is None:
         return "GeoIP ASN Edition: Unknown ASN"
@@ -59,39 +128,83 @@ def geoip2_city(result, locale: str = "en") -> str:
     )
     return "GeoIP City Edition, Rev 2: "+", ".join((str(item) for item in record if item is not None))
 
-def get_geoip(addr: str) -> str:
-    """ Get GeoIP Information """
-    numip = ipaddress.ip_address(addr)
-    if numip.is_loopback or True in (numip in item for item in MY_NETWORK):
-        ## Request originated from my own network
-        return "Welcome, our privileged StaphNet user!"
-    elif True in (numip in item for item in TRUSTED_NETWORK):
-        ## Reqest originated from a trusted peer
-        return "Welcome, our privileged peering member!"
-    elif numip.is_private:
-        ## Request originated from a private address
-        return "Welcome to StaphNet, my unknown friend!"
-    ## Otherwise we may lookup the user with db
-    with geoip2.database.Reader('/usr/share/GeoIP/city.mmdb') as reader:
-        try:
-            city = reader.city(addr)
-        except geoip2.errors.AddressNotFoundError:
-            city = None
-    with geoip2.database.Reader('/usr/share/GeoIP/asn.mmdb') as reader:
-        try:
-            asn = reader.asn(addr)
-        except geoip2.errors.AddressNotFoundError:
-            asn = None
+def network_class(addr: str) -> str:
+    """ Class of the network the address belongs to, public when unlisted """
+    return NETWORKS.lookup(addr, "public")
+
+async def get_geoip(addr: str) -> str:
+    """ Get GeoIP Information - Database lookups run in the thread pool """
+    greeting = GREETINGS.get(network_class(addr))
+    if greeting is not None:
+        return greeting
+    result = GEOIP_CACHE.get(addr)
+    if result is None:
+        ## Checked for replaced files here, only the lookup goes to a thread
+        result = await common.offload.run(
+            common.offload.THREAD, lookup_geoip, addr, CITY_DB.reader(), ASN_DB.reader()
+        )
+        GEOIP_CACHE.put(addr, result)
+    return result
+
+def lookup_geoip(addr: str, city_db, asn_db) -> str:
+    """ Look the address up in the database readers """
+    import geoip2.errors #pylint: disable=import-outside-toplevel
+    try:
+        city = city_db.city(addr)
+    except geoip2.errors.AddressNotFoundError:
+        city = None
+    try:
+        asn = asn_db.asn(addr)
+    except geoip2.errors.AddressNotFoundError:
+        asn = None
     return "".join((
         geoip2_city(city),"\n",
         geoip2_asn(asn),
         (asn or city) and DATABASE_ATTRIBUTION or ""
     ))
 
-def create_response(header: dict) -> bytes:
+def human_size(size: int) -> str:
+    """ Format bytes like free -h """
+    if size < 1024:
+        return str(size) + "B"
+    for unit in "KMGTP":
+        size /= 1024
+        if size < 1024 or unit == "P":
+            break
+    return ("%.1f" % size) + unit + "i"
+
+def format_uptime(stats: dict) -> str:
+    """ Format the snapshot like uptime """
+    minutes = int(stats["uptime"]) // 60
+    days, minutes = divmod(minutes, 1440)
+    return "".join((
+        time.strftime(" %H:%M:%S", time.localtime(stats["time"])),
+        " up ",
+        days and str(days) + (" days, ", " day, ")[days == 1] or "",
+        "%2d:%02d" % divmod(minutes, 60),
+        ",  load average: ",
+        ", ".join("%.2f" % item for item in stats["loadavg"])
+    ))
+
+def format_memory(stats: dict) -> str:
+    """ Format the snapshot like free -h """
+    mem = stats["memory"]
+    return "\n".join((
+        "".join(item.rjust(12) for item in ("", "total", "used", "free", "shared", "buff/cache", "available")),
+        "Mem:".ljust(12) + "".join(human_size(mem[item]).rjust(12) for item in (
+            "total", "used", "free", "shared", "buff_cache", "available"
+        )),
+        "Swap:".ljust(12) + "".join(human_size(mem[item]).rjust(12) for item in (
+            "swap_total", "swap_used", "swap_free"
+        ))
+    )) + "\n"
+
+async def create_response(header: dict) -> bytes:
     """ Create HTML Response """
-    sysinfo = "\t\t<pre>"+subprocess.check_output("uptime", encoding="utf-8").strip()+"</pre>\n"
-    sysinfo += "\t\t<pre>"+subprocess.check_output(("free", "-h"), encoding="utf-8")+"</pre>\n"
+    stats = SAMPLER.get()
+    sysinfo = "\t\t<pre>"+format_uptime(stats)+"</pre>\n"
+    sysinfo += "\t\t<pre>"+format_memory(stats)+"</pre>\n"
+    client = "HTTP_X_FORWARDED_FOR" in header and header["HTTP_X_FORWARDED_FOR"] or header["REMOTE_ADDR"]
     userinfo = "".join((
         "<pre>User-Agent:\t",
         header["HTTP_USER_AGENT"],
@@ -99,22 +212,24 @@ def create_response(header: dict) -> bytes:
         "<pre>Request-Addr:\t",
         header["REMOTE_ADDR"], ":", header["REMOTE_PORT"], "\n",
         "Proxy:\t\t",
-        "HTTP_X_FORWARDED_FOR" in header and header["HTTP_X_FORWARDED_FOR"] or "No transparent proxy",
+        "HTTP_X_FORWARDED_FOR" in header and header["HTTP_X_FORWARDED_FOR"] or "No transparent proxy", "\n",
+        "Network:\t", network_class(client), "\n",
         "</pre>\n"
     ))
-    ipinfo = "\t\t<pre>"+get_geoip(
-        "HTTP_X_FORWARDED_FOR" in header and header["HTTP_X_FORWARDED_FOR"] or header["REMOTE_ADDR"]
-    )+"</pre>\n"
+    ipinfo = "\t\t<pre>"+await get_geoip(client)+"</pre>\n"
 
     return "".join((HEADER, sysinfo, USER_INFO, userinfo, ipinfo, FOOTER)).encode("utf-8")
 
-async def main(header: email.message.Message, _, stdout):
+async def main(header: common.header.Header, _, stdout):
     """ Main invocation """
-    common.write_email(
-        req = header,
-        stdout = stdout,
-        resp = email.message_from_bytes(
-            b"Content-Type: text/html; charset=utf-8\n\n" + create_response(header),
-            policy=email.policy.HTTP
-        )
-    )
+    if header["DOCUMENT_URI"].endswith(".json"):
+        ## Metrics only, for monitoring scrapers
+        await common.send_response(header, stdout, common.Response(
+            headers = {"Content-Type": "application/json"},
+            body = json.dumps(SAMPLER.get())
+        ))
+        return
+    await common.send_response(header, stdout, common.Response(
+        headers = {"Content-Type": "text/html; charset=utf-8"},
+        body = await create_response(header)
+    ))